@@ -0,0 +1,467 @@
+'''
+Date: 20261018
+Purpose: Benchmark FeatureService_Azure_Helper.py offline, both its DDL rendering against the original per-call
+implementation and the full layers loop against a local stand-in for an ArcGIS REST server
+'''
+
+# In[1]:
+
+
+from functools import reduce
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+import contextlib
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+
+import FeatureService_Azure_Helper as helper
+
+
+# In[2]:
+
+# every esri field type the renderers support, cycled through to build synthetic schemas of any width
+FIELD_TYPES = [
+    ('esriFieldTypeString', 255),
+    ('esriFieldTypeString', 8000),
+    ('esriFieldTypeSmallInteger', None),
+    ('esriFieldTypeBigInteger', None),
+    ('esriFieldTypeInteger', None),
+    ('esriFieldTypeGlobalID', 38),
+    ('esriFieldTypeGUID', 38),
+    ('esriFieldTypeDate', 8),
+    ('esriFieldTypeDouble', None),
+    ('esriFieldTypeFloat', None),
+    ('esriFieldTypeSingle', None),
+    ('esriFieldTypeBlob', None),
+]
+FIELD_NAME_SUFFIXES = ['', '_SIZE_', '_CREATED_DATE', '_UPDATED_USER']
+
+
+def make_fields(
+    column_count : int
+) -> list:
+    fields = [{'name': 'OBJECTID', 'type': 'esriFieldTypeOID', 'length': None}]
+    for i in range(column_count - 1):
+        field_type, length = FIELD_TYPES[i % len(FIELD_TYPES)]
+        fields.append({
+            'name': f'FIELD_{i}{FIELD_NAME_SUFFIXES[i % len(FIELD_NAME_SUFFIXES)]}',
+            'type': field_type,
+            'length': length
+        })
+    return fields
+
+
+# In[3]:
+
+# the renderers as they were before the render engine, kept here as the reference for output and throughput
+
+def legacy_clean_field_name(name : str) -> str:
+    rename_fields = {
+        'SIZE_': 'SIZE',
+        'CREATED_DATE': 'CreationDate',
+        'UPDATED_DATE': 'EditDate',
+        'CREATED_USER': 'Creator',
+        'UPDATED_USER': 'Editor'
+    }
+    clean_name = reduce(lambda a, kv: a.replace(*kv), rename_fields.items(), name)
+    clean_name = clean_name.upper()
+
+    return clean_name
+
+def legacy_render_bronze_sql(
+    fields : list,
+    layer_type : str,
+    name : str
+) -> str:
+    start_sql = f'''USE mds_ldw
+GO
+DROP EXTERNAL TABLE bronze.B_GIS_{name.upper()}
+GO
+CREATE EXTERNAL TABLE bronze.B_GIS_{name.upper()}
+(
+'''
+    sql = ''
+    for field in fields:
+        if field['name'] not in helper.IGNORED_FIELDS:
+            sql += '    ,[' + field['name'] + '] VARCHAR(8000)' + '''
+'''
+    sql = start_sql + '    ' + sql[5:-1] + f'''
+    ,[INGEST_FILE] VARCHAR(8000)
+    ,[INGEST_TS] VARCHAR(8000)'''
+
+    if layer_type == 'Feature Layer':
+        sql = sql + f'''
+    ,[GEOMWKB] VARBINARY(MAX)
+    ,[GEOMWKT] VARCHAR(MAX)
+    ,[X] FLOAT
+    ,[Y] FLOAT
+    ,[LONGITUDE] FLOAT
+    ,[LATITUDE] FLOAT
+    ,[AREA] FLOAT
+    ,[LENGTH] FLOAT
+    ,[GEOMTYPE] VARCHAR(8000)
+    ,[COUNCIL2021] VARCHAR(8000)
+    ,[COUNCIL2021_DOMINANT] VARCHAR(8000)
+    ,[COUNCIL2021_AREAS] VARCHAR(8000)
+    ,[LEGISLATIVE2022] VARCHAR(8000)
+    ,[LEGISLATIVE2022_DOMINANT] VARCHAR(8000)
+    ,[LEGISLATIVE2022_AREAS] VARCHAR(8000)
+    ,[CONGRESS2021] VARCHAR(8000)
+    ,[CONGRESS2021_DOMINANT] VARCHAR(8000)
+    ,[CONGRESS2021_AREAS] VARCHAR(8000)
+    ,[PARKPOLICEBEAT] VARCHAR(8000)
+    ,[PARKPOLICEBEAT_DOMINANT] VARCHAR(8000)
+    ,[PARKPOLICEBEAT_AREAS] VARCHAR(8000)
+    ,[AGRESERVE] VARCHAR(8000)
+    ,[AGRESERVE_DOMINANT] VARCHAR(8000)
+    ,[AGRESERVE_AREAS] VARCHAR(8000)
+    ,[REGIONALSERVICECENTER] VARCHAR(8000)
+    ,[REGIONALSERVICECENTER_DOMINANT] VARCHAR(8000)
+    ,[REGIONALSERVICECENTER_AREAS] VARCHAR(8000)
+    ,[CENSUSTRACT2020] VARCHAR(8000)
+    ,[CENSUSTRACT2020_DOMINANT] VARCHAR(8000)
+    ,[CENSUSTRACT2020_AREAS] VARCHAR(8000)
+    ,[CENSUSTRACT2010] VARCHAR(8000)
+    ,[CENSUSTRACT2010_DOMINANT] VARCHAR(8000)
+    ,[CENSUSTRACT2010_AREAS] VARCHAR(8000)
+    ,[GEOM_PARK_CODE] VARCHAR(8000)
+    ,[GEOM_PARK_CODE_DOMINANT] VARCHAR(8000)
+    ,[GEOM_PARK_CODE_AREAS] VARCHAR(8000)
+    ,[GEOM_PARK_CODE_NEAREST] VARCHAR(8000)
+    ,[GEOM_PARK_CODE_NEARESTDISTANCE] FLOAT
+    ,[GEOM_PARK_CODE_NEARESTAREAS] VARCHAR(8000)'''
+
+    sql = sql + f'''
+)  
+WITH (
+    LOCATION = '/bronze/gis-bronze/{name}/**',
+    DATA_SOURCE = mds_ldw_source,  
+    FILE_FORMAT = raw_ion_parquet
+)
+GO
+
+-- SELECT TOP 1 * FROM bronze.B_GIS_{name.upper()}
+    '''
+
+    return sql
+
+def legacy_render_silver_fields(
+    fields : list,
+    layer_type : str
+) -> str:
+    type_mappings = {
+        'esriFieldTypeString': lambda field: f"CAST([{field['name']}] AS VARCHAR({field['length'] if field['length'] < 8000 else 'MAX'})) AS [{legacy_clean_field_name(field['name'])}]",
+        'esriFieldTypeSmallInteger': lambda field: f"CAST(CAST([{field['name']}] AS FLOAT) AS INT) AS [{legacy_clean_field_name(field['name'])}]",
+        'esriFieldTypeBigInteger': lambda field: f"CAST(CAST([{field['name']}] AS FLOAT) AS BIGINT) AS [{legacy_clean_field_name(field['name'])}]",
+        'esriFieldTypeInteger': lambda field: f"CAST(CAST([{field['name']}] AS FLOAT) AS INT) AS [{legacy_clean_field_name(field['name'])}]",
+        'esriFieldTypeOID': lambda field: f"CAST([{field['name']}] AS INT) AS [{legacy_clean_field_name(field['name'])}]",
+        'esriFieldTypeGlobalID': lambda field: f"CAST([{field['name']}] AS CHAR(36)) AS [{legacy_clean_field_name(field['name'])}]",
+        'esriFieldTypeGUID': lambda field: f"CAST([{field['name']}] AS CHAR(36)) AS [{legacy_clean_field_name(field['name'])}]",
+        'esriFieldTypeDate': lambda field: f"""DATEADD(S, CAST([{field['name']}] AS FLOAT)/1000, '1970-01-01') AT TIME ZONE 'UTC' AT TIME ZONE 'Eastern Standard Time' AS [{legacy_clean_field_name(field['name'])}]""",
+        'esriFieldTypeDouble' : lambda field: f"CAST([{field['name']}] AS NUMERIC(38, 8)) AS [{legacy_clean_field_name(field['name'])}]",
+        'esriFieldTypeFloat' : lambda field: f"CAST([{field['name']}] AS NUMERIC(12, 6)) AS [{legacy_clean_field_name(field['name'])}]",
+        'esriFieldTypeSingle' : lambda field: f"CAST([{field['name']}] AS NUMERIC(12, 6)) AS [{legacy_clean_field_name(field['name'])}]",
+        'esriFieldTypeBlob': lambda field: f"CAST([{field['name']}] AS BINARY) AS [{legacy_clean_field_name(field['name'])}]"
+    }
+    sql = ''''''
+    for field in fields:
+        if field['name'] not in helper.IGNORED_FIELDS and field['type'] != 'esriFieldTypeGeometry':
+            sql += '    ,' + type_mappings[field['type']](field) + '''
+'''
+    sql = '    ' + sql[5:-1] + '''
+    ,[INGEST_TS]
+    ,[INGEST_FILE]'''
+
+    if layer_type == 'Feature Layer':
+        sql = sql + '''
+    ,[GEOMWKB]
+    ,[GEOMWKT]
+    ,ROUND([X], 8) AS [X]
+    ,ROUND([Y], 8) AS [Y]
+    ,ROUND([LONGITUDE], 8) AS [LONGITUDE]
+    ,ROUND([LATITUDE], 8) AS [LATITUDE]
+    ,ROUND([LENGTH], 4) AS [LENGTH]
+    ,ROUND([AREA], 4) AS [AREA]
+    ,CAST([GEOMTYPE] AS VARCHAR(30)) AS [GEOMTYPE]
+    ,CAST([COUNCIL2021] AS VARCHAR(1020)) AS [COUNCIL2021]
+    ,CAST([COUNCIL2021_DOMINANT] AS VARCHAR(255)) AS [COUNCIL2021_DOMINANT]
+    ,CAST([COUNCIL2021_AREAS] AS VARCHAR(MAX)) AS [COUNCIL2021_AREAS]
+    ,CAST([LEGISLATIVE2022] AS VARCHAR(1020)) AS [LEGISLATIVE2022]
+    ,CAST([LEGISLATIVE2022_DOMINANT] AS VARCHAR(255)) AS [LEGISLATIVE2022_DOMINANT]
+    ,CAST([LEGISLATIVE2022_AREAS] AS VARCHAR(MAX)) AS [LEGISLATIVE2022_AREAS]
+    ,CAST([CONGRESS2021] AS VARCHAR(1020)) AS [CONGRESS2021]
+    ,CAST([CONGRESS2021_DOMINANT] AS VARCHAR(255)) AS [CONGRESS2021_DOMINANT]
+    ,CAST([CONGRESS2021_AREAS] AS VARCHAR(MAX)) AS [CONGRESS2021_AREAS]
+    ,CAST([PARKPOLICEBEAT] AS VARCHAR(1020)) AS [PARKPOLICEBEAT]
+    ,CAST([PARKPOLICEBEAT_DOMINANT] AS VARCHAR(255)) AS [PARKPOLICEBEAT_DOMINANT]
+    ,CAST([PARKPOLICEBEAT_AREAS] AS VARCHAR(MAX)) AS [PARKPOLICEBEAT_AREAS]
+    ,CAST([REGIONALSERVICECENTER] AS VARCHAR(1020)) AS [REGIONALSERVICECENTER]
+    ,CAST([REGIONALSERVICECENTER_DOMINANT] AS VARCHAR(255)) AS [REGIONALSERVICECENTER_DOMINANT]
+    ,CAST([REGIONALSERVICECENTER_AREAS] AS VARCHAR(MAX)) AS [REGIONALSERVICECENTER_AREAS]
+    ,CAST([AGRESERVE] AS VARCHAR(1020)) AS [AGRESERVE]
+    ,CAST([AGRESERVE_DOMINANT] AS VARCHAR(255)) AS [AGRESERVE_DOMINANT]
+    ,CAST([AGRESERVE_AREAS] AS VARCHAR(MAX)) AS [AGRESERVE_AREAS]
+    ,CAST([CENSUSTRACT2020] AS VARCHAR(1020)) AS [CENSUSTRACT2020]
+    ,CAST([CENSUSTRACT2020_DOMINANT] AS VARCHAR(255)) AS [CENSUSTRACT2020_DOMINANT]
+    ,CAST([CENSUSTRACT2020_AREAS] AS VARCHAR(MAX)) AS [CENSUSTRACT2020_AREAS]
+    ,CAST([CENSUSTRACT2010] AS VARCHAR(1020)) AS [CENSUSTRACT2010]
+    ,CAST([CENSUSTRACT2010_DOMINANT] AS VARCHAR(255)) AS [CENSUSTRACT2010_DOMINANT]
+    ,CAST([CENSUSTRACT2010_AREAS] AS VARCHAR(MAX)) AS [CENSUSTRACT2010_AREAS]
+    ,CAST([GEOM_PARK_CODE] AS VARCHAR(150)) AS [GEOM_PARK_CODE]
+    ,CAST([GEOM_PARK_CODE_DOMINANT] AS VARCHAR(30)) AS [GEOM_PARK_CODE_DOMINANT]
+    ,CAST([GEOM_PARK_CODE_AREAS] AS VARCHAR(MAX)) AS [GEOM_PARK_CODE_AREAS]
+    ,CAST([GEOM_PARK_CODE_NEAREST] AS VARCHAR(30)) AS [GEOM_PARK_CODE_NEAREST]
+    ,ROUND([GEOM_PARK_CODE_NEARESTDISTANCE], 4) AS [GEOM_PARK_CODE_NEARESTDISTANCE]
+    ,CAST([GEOM_PARK_CODE_NEARESTAREAS] AS VARCHAR(MAX)) AS [GEOM_PARK_CODE_NEARESTAREAS]'''
+
+    return sql
+
+
+# In[4]:
+
+def benchmark_render(
+    column_count : int = 10000,
+    repeat : int = 5
+) -> list:
+    # times the legacy and compiled renderers on the same schema after checking that their output is identical
+    fields = make_fields(column_count)
+    cases = [
+        ('bronze', legacy_render_bronze_sql, helper.render_bronze_sql, {'layer_type': 'Feature Layer', 'name': 'Benchmark'}),
+        ('silver', legacy_render_silver_fields, helper.render_silver_fields, {'layer_type': 'Feature Layer'}),
+    ]
+    results = []
+    for label, legacy, compiled, kwargs in cases:
+        if legacy(fields, **kwargs) != compiled(fields, **kwargs):
+            raise AssertionError(f'{label} output differs from the legacy renderer')
+        for implementation, render in (('legacy', legacy), ('compiled', compiled)):
+            seconds = min(timeit.repeat(lambda: render(fields, **kwargs), number=1, repeat=repeat))
+            results.append({
+                'renderer': label,
+                'implementation': implementation,
+                'columns': column_count,
+                'seconds': seconds,
+                'columns_per_second': column_count / seconds
+            })
+    return results
+
+def print_results(
+    results : list
+) -> None:
+    for result in results:
+        print(f"{result['renderer']:<8} {result['implementation']:<9} {result['columns']:>7} columns  {result['seconds'] * 1000:>9.2f} ms  {result['columns_per_second']:>12,.0f} columns/s")
+
+
+# In[5]:
+
+# recorded layer json served by the stub server. each file is either a layer's raw json or a snapshot entry saved by
+# save_featurelayer_snapshots, so real services can be dropped in next to the defaults
+RECORDED_LAYERS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_layers')
+
+# the order in which layer kinds are assigned to the sublayers of each generated service, and how many sublayers
+# each service gets, so the benchmark has a realistic mix of single and multi layer services
+SERVICE_LAYOUTS = [
+    ('FeatureServer', ['point']),
+    ('FeatureServer', ['point', 'point']),
+    ('FeatureServer', ['point', 'table', 'table', 'table', 'table']),
+    ('FeatureServer', ['polygon']),
+    ('FeatureServer', ['point', 'polygon', 'table']),
+    ('MapServer', ['census_tracts_mapserver']),
+    ('FeatureServer', ['table']),
+]
+
+
+def load_recorded_layers(
+    recorded_layers_dir : str = None
+) -> dict:
+    recorded_layers = {}
+    recorded_layers_dir = recorded_layers_dir or RECORDED_LAYERS_DIR
+    for file_name in sorted(os.listdir(recorded_layers_dir)):
+        if file_name.endswith('.json'):
+            with open(os.path.join(recorded_layers_dir, file_name), encoding='utf-8') as f:
+                layer = json.load(f)
+            recorded_layers[file_name[:-5]] = layer.get('properties', layer)
+    return recorded_layers
+
+
+class StubArcGISServer:
+    # serves .../<service>/FeatureServer|MapServer, .../<id> and .../layers from the recorded layer json. the layer kinds
+    # of a service are encoded in its name, e.g. Service12__point__table, so any number of services can be served
+    # without keeping state. every request is counted and can be delayed to stand in for network latency
+    SERVICE_PATH = re.compile(r'^/arcgis/rest/services/(?P<service>[^/]+)/(?P<server>FeatureServer|MapServer)(?:/(?P<resource>layers|\d+))?/?$')
+
+    def __init__(
+        self,
+        recorded_layers : dict,
+        latency : float = 0
+    ):
+        self.recorded_layers = recorded_layers
+        self.latency = latency
+        self.request_count = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self._server.server_port}'
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_request_count(self) -> None:
+        with self._lock:
+            self.request_count = 0
+
+    def get_resource(self, path : str) -> dict:
+        match = self.SERVICE_PATH.match(path)
+        if not match:
+            return None
+        kinds = match.group('service').split('__')[1:]
+        layers = []
+        for layer_id, kind in enumerate(kinds):
+            layer = dict(self.recorded_layers[kind], id=layer_id)
+            layers.append(layer)
+
+        resource = match.group('resource')
+        if resource is None:
+            service = {
+                'currentVersion': 11.3,
+                'layers': [{'id': layer['id'], 'name': layer.get('name')} for layer in layers if layer['type'] != 'Table'],
+                'tables': [{'id': layer['id'], 'name': layer.get('name')} for layer in layers if layer['type'] == 'Table'],
+            }
+            if match.group('server') == 'FeatureServer':
+                service['editingInfo'] = {'schemaLastEditDate': max((layer.get('editingInfo') or {}).get('schemaLastEditDate', 0) for layer in layers)}
+            return service
+        if resource == 'layers':
+            return {
+                'layers': [layer for layer in layers if layer['type'] != 'Table'],
+                'tables': [layer for layer in layers if layer['type'] == 'Table'],
+            }
+        if int(resource) < len(layers):
+            return layers[int(resource)]
+        return None
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body go out as separate writes, which nagle holds back until the client's delayed ack on a
+            # keep-alive connection, adding about 40 ms to every request
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with stub._lock:
+                    stub.request_count += 1
+                if stub.latency:
+                    time.sleep(stub.latency)
+                resource = stub.get_resource(urlsplit(self.path).path)
+                if resource is None:
+                    resource = {'error': {'code': 400, 'message': 'Invalid URL', 'details': []}}
+                body = json.dumps(resource).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+
+def make_layers(
+    server_url : str,
+    layer_count : int
+) -> list:
+    # builds a layers list like the one in the helper, cycling through SERVICE_LAYOUTS until layer_count is reached
+    layers = []
+    service_number = 0
+    while len(layers) < layer_count:
+        server, kinds = SERVICE_LAYOUTS[service_number % len(SERVICE_LAYOUTS)]
+        kinds = kinds[:layer_count - len(layers)]
+        service_name = '__'.join([f'Service{service_number}', *kinds])
+        for layer_id in range(len(kinds)):
+            layers.append((f'Service{service_number}Layer{layer_id}', f'{server_url}/arcgis/rest/services/{service_name}/{server}/{layer_id}'))
+        service_number += 1
+    return layers
+
+def run_layers(
+    layers : list,
+    gis,
+    prefetch : bool = True
+) -> None:
+    # the driver loop from the helper, with its printed output discarded
+    with contextlib.redirect_stdout(io.StringIO()):
+        if prefetch:
+            helper.prefetch_featurelayer_properties([layer[1] for layer in layers], gis=gis)
+        for name, url in layers:
+            helper.get_featurelayer_field_names(url, gis=gis)
+            helper.get_featurelayer_stage_parameters(url, gis=gis, name=name)
+            helper.get_featurelayer_bronzesqlfields(url, gis=gis, name=name)
+            helper.get_featurelayer_silversqlprocedure(url, gis=gis, name=name)
+
+def benchmark_layers(
+    layer_counts : list = (10, 100, 1000),
+    latency : float = 0.02,
+    recorded_layers_dir : str = None
+) -> list:
+    # runs the full layers loop against the stub server at each size. cold runs start from an empty cache, warm runs
+    # reuse the on-disk cache of the cold run in a new process state, and sequential runs skip the prefetch
+    results = []
+    original_cache_dir = helper.LAYER_CACHE_DIR
+    with StubArcGISServer(load_recorded_layers(recorded_layers_dir), latency=latency) as server:
+        backend = helper.RestBackend(url=server.url)
+        # the stub has no rate budget, so the results measure the helper rather than the throttling
+        helper.HOST_RATE_LIMITS[urlsplit(server.url).hostname] = (1e9, 1e9)
+        try:
+            for layer_count in layer_counts:
+                layers = make_layers(server.url, layer_count)
+                with tempfile.TemporaryDirectory() as cache_dir:
+                    helper.LAYER_CACHE_DIR = cache_dir
+                    for scenario, prefetch, clear_disk in (('sequential', False, True), ('cold', True, True), ('warm', True, False)):
+                        helper.clear_layer_cache(on_disk=clear_disk)
+                        server.reset_request_count()
+                        tracemalloc.start()
+                        start = time.perf_counter()
+                        run_layers(layers, gis=backend, prefetch=prefetch)
+                        seconds = time.perf_counter() - start
+                        peak_memory = tracemalloc.get_traced_memory()[1]
+                        tracemalloc.stop()
+                        results.append({
+                            'layers': layer_count,
+                            'scenario': scenario,
+                            'seconds': seconds,
+                            'requests': server.request_count,
+                            'peak_memory_mb': peak_memory / 1024 / 1024
+                        })
+        finally:
+            helper.LAYER_CACHE_DIR = original_cache_dir
+            helper.HOST_RATE_LIMITS.pop(urlsplit(server.url).hostname, None)
+            helper.clear_layer_cache()
+    return results
+
+def print_layer_results(
+    results : list
+) -> None:
+    for result in results:
+        print(f"{result['layers']:>5} layers  {result['scenario']:<10}  {result['seconds']:>8.2f} s  {result['requests']:>6} requests  {result['peak_memory_mb']:>8.1f} MB peak")
+
+
+# In[ ]:
+if __name__ == '__main__':
+    start = time.perf_counter()
+    print_results(benchmark_render(column_count=10000))
+    print('')
+    print_layer_results(benchmark_layers())
+    print(f'finished in {time.perf_counter() - start:.2f} s')
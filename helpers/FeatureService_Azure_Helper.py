@@ -7,11 +7,422 @@ Purpose: Help draft parameters, T-SQL, etc. for querying data originating from a
 # In[1]:
 
 
-from arcgis.gis import GIS
-from arcgis.features import FeatureLayer
-from functools import reduce
+from __future__ import annotations
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache, reduce, wraps
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlencode, urlsplit
+import argparse
+import gzip
+import hashlib
+import http.client
+import json
+import os
+import queue
+import random
 import re
-gis = GIS(profile="work")
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from arcgis.gis import GIS
+
+
+# run metrics: every metadata request, sign in, cache lookup and generator call is counted and timed in process, so
+# a run can end with a report of where its time went (see render_run_metrics_json and render_run_metrics_prometheus).
+# when METRICS_DIR is set the driver writes both reports there for the scheduler to collect
+METRICS_DIR = os.environ.get('FEATURESERVICE_HELPER_METRICS_DIR')
+METRICS_PREFIX = 'featureservice_helper_'
+# (prometheus type, help) of each metric. timings are exported as summaries with a separate max gauge
+METRICS = {
+    'request_seconds': ('summary', 'Time spent on metadata requests, by host and outcome.'),
+    'request_wait_seconds': ('summary', 'Time requests waited for a free per host request slot.'),
+    'sign_in_seconds': ('summary', 'Time spent signing in, by method.'),
+    'cache_lookups_total': ('counter', 'Layer properties and field profile lookups, by cache and result.'),
+    'generator_seconds': ('summary', 'Time spent in each generator function, including any fetches it triggered.'),
+    'request_retries_total': ('counter', 'Metadata requests retried after a throttling response, server error or timeout, by host.'),
+    'rate_limit_wait_seconds': ('summary', 'Time requests waited for their host\'s rate budget.'),
+    'circuit_breaker_trips_total': ('counter', 'Times a host was taken out of rotation after consecutive failures.'),
+    'circuit_breaker_rejections_total': ('counter', 'Requests failed fast because their host was out of rotation.'),
+}
+
+_metric_counters = defaultdict(int)
+_metric_timings = {}
+_metrics_lock = threading.Lock()
+_run_started_at = time.time()
+
+
+def record_metric_count(
+    metric : str,
+    value : int = 1,
+    **labels
+) -> None:
+    with _metrics_lock:
+        _metric_counters[(metric, tuple(sorted(labels.items())))] += value
+
+def record_metric_timing(
+    metric : str,
+    seconds : float,
+    **labels
+) -> None:
+    key = (metric, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        count, total, maximum = _metric_timings.get(key, (0, 0.0, 0.0))
+        _metric_timings[key] = (count + 1, total + seconds, max(maximum, seconds))
+
+@contextmanager
+def timed_metric(
+    metric : str,
+    **labels
+):
+    # records the time spent in the block. a block that raises is recorded with outcome='error' when the metric
+    # has an outcome label
+    started_at = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        if 'outcome' in labels:
+            labels['outcome'] = 'error'
+        raise
+    finally:
+        record_metric_timing(metric, time.perf_counter() - started_at, **labels)
+
+def timed_generator(function):
+    # times every call of a get_featurelayer_* generator under its function name
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with timed_metric('generator_seconds', function=function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
+
+def reset_run_metrics() -> None:
+    global _run_started_at
+    with _metrics_lock:
+        _metric_counters.clear()
+        _metric_timings.clear()
+        _run_started_at = time.time()
+
+def get_run_metrics() -> dict:
+    with _metrics_lock:
+        counters = dict(_metric_counters)
+        timings = dict(_metric_timings)
+        started_at = _run_started_at
+    return {
+        'started_at': started_at,
+        'run_seconds': time.time() - started_at,
+        'counters': [
+            {'name': metric, 'labels': dict(labels), 'value': value}
+            for (metric, labels), value in sorted(counters.items())
+        ],
+        'timings': [
+            {'name': metric, 'labels': dict(labels), 'count': count, 'sum_seconds': total, 'max_seconds': maximum}
+            for (metric, labels), (count, total, maximum) in sorted(timings.items())
+        ]
+    }
+
+def render_run_metrics_json(
+    metrics : dict = None
+) -> str:
+    return json.dumps(metrics or get_run_metrics(), indent=2)
+
+def render_run_metrics_prometheus(
+    metrics : dict = None
+) -> str:
+    # prometheus text exposition format, e.g. for the node exporter's textfile collector
+    metrics = metrics or get_run_metrics()
+    def render_labels(labels):
+        if not labels:
+            return ''
+        escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels.items()) + '}'
+
+    lines = [
+        f'# HELP {METRICS_PREFIX}run_seconds Duration of the run so far.',
+        f'# TYPE {METRICS_PREFIX}run_seconds gauge',
+        f"{METRICS_PREFIX}run_seconds {metrics['run_seconds']:.6f}",
+    ]
+    for metric, (metric_type, description) in METRICS.items():
+        counters = [counter for counter in metrics['counters'] if counter['name'] == metric]
+        timings = [timing for timing in metrics['timings'] if timing['name'] == metric]
+        if not counters and not timings:
+            continue
+        lines.append(f'# HELP {METRICS_PREFIX}{metric} {description}')
+        lines.append(f'# TYPE {METRICS_PREFIX}{metric} {metric_type}')
+        for counter in counters:
+            lines.append(f"{METRICS_PREFIX}{metric}{render_labels(counter['labels'])} {counter['value']}")
+        for timing in timings:
+            lines.append(f"{METRICS_PREFIX}{metric}_sum{render_labels(timing['labels'])} {timing['sum_seconds']:.6f}")
+            lines.append(f"{METRICS_PREFIX}{metric}_count{render_labels(timing['labels'])} {timing['count']}")
+        if timings:
+            lines.append(f'# TYPE {METRICS_PREFIX}{metric}_max gauge')
+            for timing in timings:
+                lines.append(f"{METRICS_PREFIX}{metric}_max{render_labels(timing['labels'])} {timing['max_seconds']:.6f}")
+    return '\n'.join(lines) + '\n'
+
+def write_run_metrics(
+    metrics_dir : str
+) -> None:
+    # writes run_metrics.json and run_metrics.prom, replacing the previous run's
+    metrics = get_run_metrics()
+    os.makedirs(metrics_dir, exist_ok=True)
+    for file_name, content in (('run_metrics.json', render_run_metrics_json(metrics)), ('run_metrics.prom', render_run_metrics_prometheus(metrics))):
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=metrics_dir, suffix='.tmp', delete=False) as f:
+            f.write(content)
+        os.replace(f.name, os.path.join(metrics_dir, file_name))
+
+
+class LazyGIS:
+    # stands in for arcgis.gis.GIS so that importing this module neither imports arcgis nor signs in. the real
+    # connection is made the first time a request needs it
+    def __init__(self, *args, **kwargs):
+        self._args = args
+        self._kwargs = kwargs
+        self._gis = None
+        self._lock = threading.Lock()
+
+    def connect(self) -> GIS:
+        with self._lock:
+            if self._gis is None:
+                with timed_metric('sign_in_seconds', method='arcgis'):
+                    from arcgis.gis import GIS
+                    self._gis = GIS(*self._args, **self._kwargs)
+        return self._gis
+
+    def __getattr__(self, name):
+        return getattr(self.connect(), name)
+
+def resolve_gis(
+    gis : GIS
+) -> GIS:
+    return gis.connect() if isinstance(gis, LazyGIS) else gis
+
+class ArcGISRestError(Exception):
+    # raised for error responses from an arcgis rest endpoint, which usually arrive as http 200 with an error body.
+    # retry_after is the server's Retry-After in seconds, when it sent one
+    def __init__(self, url : str, code : int, message : str, retry_after : float = None):
+        super().__init__(f'{url} returned {code}: {message}')
+        self.url = url
+        self.code = code
+        self.retry_after = retry_after
+
+class HostUnavailableError(ArcGISRestError):
+    # raised without sending a request while a host's circuit breaker is open
+    def __init__(self, url : str, retry_after : float):
+        super().__init__(url, 503, f'{urlsplit(url).hostname} is out of rotation after repeated failures or a long Retry-After', retry_after=retry_after)
+
+def parse_retry_after(
+    value : str
+) -> float:
+    # Retry-After is either a number of seconds or an http date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class MetadataBackend:
+    # everything the helper needs from a connection: the portal url and json from rest endpoints. pass an instance
+    # anywhere a gis is accepted to choose how metadata is requested
+    url = None
+
+    def get_json(self, url : str, params : dict = None) -> dict:
+        raise NotImplementedError
+
+    def post_json(self, url : str, params : dict = None) -> dict:
+        # for requests whose parameters are too long for a query string. backends that only read use get_json
+        return self.get_json(url, params)
+
+    def get_json_if_modified(self, url : str, validators : dict = None) -> tuple:
+        # conditional request for url. returns (json, validators), or (None, validators) when nothing changed since
+        # the response the validators came from. backends without conditional requests always return the json
+        return self.get_json(url), {}
+
+
+class ArcGISBackend(MetadataBackend):
+    # requests go through the arcgis sdk connection of a GIS (or LazyGIS), including its sign in and token handling
+    def __init__(self, gis : GIS):
+        self.gis = gis
+
+    @property
+    def url(self) -> str:
+        return resolve_gis(self.gis).url
+
+    def request(self, method : str, url : str, params : dict = None) -> dict:
+        connection = resolve_gis(self.gis)._con
+        try:
+            response = (connection.post if method == 'POST' else connection.get)(url, {'f': 'json', **(params or {})})
+        except Exception as e:
+            # the sdk raises plain exceptions for error responses, the code is only found in the message
+            code = re.search(r'Error Code: (\d+)', str(e))
+            if code is None:
+                raise
+            raise ArcGISRestError(url, int(code.group(1)), str(e)) from e
+        return json.loads(json.dumps(response))
+
+    def get_json(self, url : str, params : dict = None) -> dict:
+        return self.request('GET', url, params)
+
+    def post_json(self, url : str, params : dict = None) -> dict:
+        return self.request('POST', url, params)
+
+
+class RestBackend(MetadataBackend):
+    # minimal rest client on the standard library. keeps a pool of keep-alive connections per host that is shared by
+    # every layer, and signs in to the portal at url with generateToken when a username and password are given.
+    # the token is only sent to the portal and arcgis online hosted services, never to third party servers
+    def __init__(
+        self,
+        url : str = 'https://www.arcgis.com',
+        username : str = None,
+        password : str = None,
+        token : str = None,
+        pool_size : int = 8,
+        timeout : float = 60
+    ):
+        self.url = url.rstrip('/')
+        self.username = username
+        self.password = password
+        self.token = token
+        self.token_expires = None
+        self.token_hosts = {urlsplit(self.url).hostname}
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._pools = defaultdict(lambda: queue.LifoQueue(maxsize=self.pool_size))
+        self._token_lock = threading.Lock()
+
+    def _connection(self, scheme : str, netloc : str) -> http.client.HTTPConnection:
+        try:
+            return self._pools[(scheme, netloc)].get_nowait()
+        except queue.Empty:
+            connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+            return connection_class(netloc, timeout=self.timeout)
+
+    def _release(self, scheme : str, netloc : str, connection : http.client.HTTPConnection) -> None:
+        try:
+            self._pools[(scheme, netloc)].put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def send(self, method : str, url : str, params : dict = None, headers : dict = None) -> tuple:
+        # returns the response and its decompressed body. a 304 to a conditional request has an empty body
+        parts = urlsplit(url)
+        body = urlencode(params or {})
+        path = parts.path or '/'
+        # the token from generateToken is bound to the portal url as referer, which every request has to send with it
+        headers = {'Accept-Encoding': 'gzip', 'Connection': 'keep-alive', 'Referer': self.url, **(headers or {})}
+        if method == 'GET':
+            path = f'{path}?{body}'
+            body = None
+        else:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        # a pooled connection may have been closed by the server since it was last used, so retry once on a new one
+        for attempt in range(2):
+            connection = self._connection(parts.scheme, parts.netloc)
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                content = response.read()
+            except (http.client.HTTPException, ConnectionError):
+                connection.close()
+                if attempt:
+                    raise
+                continue
+            if response.getheader('Connection', '').lower() == 'close':
+                connection.close()
+            else:
+                self._release(parts.scheme, parts.netloc, connection)
+            if response.status >= 400:
+                raise ArcGISRestError(url, response.status, response.reason, retry_after=parse_retry_after(response.getheader('Retry-After')))
+            if response.getheader('Content-Encoding', '').lower() == 'gzip':
+                content = gzip.decompress(content)
+            return response, content
+
+    def request(self, method : str, url : str, params : dict = None) -> bytes:
+        return self.send(method, url, params)[1]
+
+    def get_token(self) -> str:
+        if self.username is None:
+            return self.token
+        with self._token_lock:
+            # refreshes a minute before expiry so a token never lapses mid request
+            if self.token is None or self.token_expires is None or time.time() * 1000 > self.token_expires - 60000:
+                with timed_metric('sign_in_seconds', method='generate_token'):
+                    response = json.loads(self.request('POST', f'{self.url}/sharing/rest/generateToken', {
+                        'username': self.username,
+                        'password': self.password,
+                        'referer': self.url,
+                        'expiration': 60,
+                        'f': 'json'
+                    }))
+                if 'error' in response:
+                    raise ArcGISRestError(f'{self.url}/sharing/rest/generateToken', response['error'].get('code'), response['error'].get('message'))
+                self.token = response['token']
+                self.token_expires = response['expires']
+            return self.token
+
+    def get_params(self, url : str, params : dict = None) -> dict:
+        params = {'f': 'json', **(params or {})}
+        host = urlsplit(url).hostname or ''
+        if host in self.token_hosts or host.endswith('.arcgis.com'):
+            token = self.get_token()
+            if token:
+                params['token'] = token
+        return params
+
+    def parse_json(self, url : str, content : bytes) -> dict:
+        response = json.loads(content)
+        if isinstance(response, dict) and 'error' in response:
+            raise ArcGISRestError(url, response['error'].get('code'), response['error'].get('message'))
+        return response
+
+    def get_json(self, url : str, params : dict = None) -> dict:
+        return self.parse_json(url, self.request('GET', url, self.get_params(url, params)))
+
+    def post_json(self, url : str, params : dict = None) -> dict:
+        return self.parse_json(url, self.request('POST', url, self.get_params(url, params)))
+
+    def get_json_if_modified(self, url : str, validators : dict = None) -> tuple:
+        # sends the etag and last modified date of the previous response back, servers that support either answer
+        # 304 with no body when the json is unchanged
+        validators = validators or {}
+        headers = {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+        response, content = self.send('GET', url, self.get_params(url), headers)
+        if response.status == 304:
+            return None, validators
+        return self.parse_json(url, content), {'etag': response.getheader('ETag'), 'last_modified': response.getheader('Last-Modified')}
+
+
+_backends = {}
+
+def get_backend(
+    gis : GIS
+) -> MetadataBackend:
+    # every get_featurelayer_* function accepts either a backend or a GIS, which is wrapped in an ArcGISBackend
+    if isinstance(gis, MetadataBackend):
+        return gis
+    with _shared_state_lock:
+        if id(gis) not in _backends:
+            _backends[id(gis)] = ArcGISBackend(gis)
+        return _backends[id(gis)]
+
+# RestBackend(url=<portal url>, username=..., password=...) can be used instead to skip the arcgis sdk entirely
+gis = LazyGIS(profile="work")
 
 
 # In[48]:
@@ -28,18 +439,592 @@ IGNORED_FIELDS = [
 
 # In[49]:
 
+# layer properties are memoized in-process and persisted on disk, keyed by layer url. entries older than the ttl
+# are revalidated against the service's editingInfo.schemaLastEditDate before the layer itself is fetched again
+LAYER_CACHE_DIR = os.environ.get(
+    'FEATURESERVICE_HELPER_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'featureservice_azure_helper')
+)
+LAYER_CACHE_TTL = int(os.environ.get('FEATURESERVICE_HELPER_CACHE_TTL', 24 * 60 * 60))
+
+# when set, layer properties are only read from the saved snapshots in this directory (see save_featurelayer_snapshots)
+# and nothing is imported from arcgis or requested over the network
+OFFLINE_SNAPSHOT_DIR = os.environ.get('FEATURESERVICE_HELPER_OFFLINE_DIR')
+
+# only these keys of a layer's json (and of each of its fields) are kept in the cache, which keeps the entries
+# small even for layers with large domains, renderers or drawing info
+LAYER_PROPERTY_KEYS = (
+    'id',
+    'name',
+    'type',
+    'geometryType',
+    'serviceItemId',
+    'objectIdField',
+    'globalIdField',
+    'fields',
+    'editingInfo',
+    'editFieldsInfo',
+    'capabilities',
+    'maxRecordCount',
+    'standardMaxRecordCount',
+    'supportsStatistics',
+    'supportsAdvancedQueries',
+    'advancedQueryCapabilities',
+)
+FIELD_PROPERTY_KEYS = ('name', 'type', 'alias', 'length', 'nullable', 'editable')
+
+_layer_properties_cache = {}
+_service_properties_cache = {}
+
+# field profiles (longest string and numeric range of each field, see get_featurelayer_profile) describe the data
+# rather than the schema, so they are cached under their own directory and ttl. the directory is a subdirectory of
+# LAYER_CACHE_DIR (and of a snapshot), resolved on each use so that pointing LAYER_CACHE_DIR elsewhere moves both
+FIELD_PROFILE_CACHE_SUBDIR = 'profiles'
+FIELD_PROFILE_TTL = int(os.environ.get('FEATURESERVICE_HELPER_PROFILE_TTL', 7 * 24 * 60 * 60))
+# outStatistics definitions sent per query request, which keeps the GET url of wide layers to a sane length
+FIELD_PROFILE_STATISTICS_PER_REQUEST = 60
+
+_field_profile_cache = {}
+
+# item owners are looked up from the portal in batches of item ids (see prefetch_item_owners) and kept on disk, since
+# items rarely change owner. each owner's developer credential is stored as a secret named arcgisonline-<owner> with
+# the '.' characters removed, unless OWNER_SECRET_NAMES maps the owner to another secret
+ITEM_SEARCH_BATCH_SIZE = 50
+OWNER_SECRET_NAMES = {}
+
+_item_owner_cache = {}
+# ids the portal did not return this run, so they are only searched for once per run
+_item_owners_not_found = set()
+
+# caps the number of simultaneous requests sent to each host, since the enterprise server and arcgis online
+# throttle differently. hosts that are not listed get DEFAULT_HOST_CONCURRENCY
+HOST_CONCURRENCY = {
+    'services1.arcgis.com': 8,
+    'utility.arcgis.com': 4,
+    'montgomeryplans.org': 2,
+    'tigerweb.geo.census.gov': 2,
+}
+DEFAULT_HOST_CONCURRENCY = 4
+# sustained requests per second and burst size of each host's token bucket, so a large prefetch is spread out
+# instead of running into arcgis online's throttling. hosts that are not listed get DEFAULT_HOST_RATE_LIMIT
+HOST_RATE_LIMITS = {
+    'services1.arcgis.com': (20, 40),
+    'utility.arcgis.com': (10, 20),
+    'montgomeryplans.org': (5, 10),
+    'tigerweb.geo.census.gov': (2, 4),
+}
+DEFAULT_HOST_RATE_LIMIT = (10, 20)
+# throttling responses, server errors and timeouts are retried with jittered exponential backoff, never sooner
+# than the server's Retry-After. a Retry-After over REQUEST_RETRY_MAX_DELAY fails the request and takes the host out
+# of rotation for as long as asked
+REQUEST_RETRIES = int(os.environ.get('FEATURESERVICE_HELPER_REQUEST_RETRIES', 4))
+REQUEST_RETRY_BASE_DELAY = 0.5
+REQUEST_RETRY_MAX_DELAY = 30
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+# after this many consecutive failed attempts a host is taken out of rotation, and its requests fail fast, until
+# a single trial request after the cooldown succeeds. the other hosts are not affected. it is above the attempts of
+# a single request, so one broken service does not take down the rest of its host
+CIRCUIT_BREAKER_FAILURES = 10
+CIRCUIT_BREAKER_COOLDOWN = 60
+
+_host_semaphores = {}
+_host_rate_limiters = {}
+_host_breakers = defaultdict(lambda: {'failures': 0, 'open_until': None})
+_url_locks = defaultdict(threading.Lock)
+_shared_state_lock = threading.Lock()
+
+
+class TokenBucket:
+    # allows rate requests per second on average and bursts of up to capacity
+    def __init__(self, rate : float, capacity : float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        # takes a token, sleeping until one is available, and returns the time waited
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+@contextmanager
+def host_request_slot(
+    url : str
+):
+    host = urlsplit(url).hostname
+    with _shared_state_lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = threading.BoundedSemaphore(HOST_CONCURRENCY.get(host, DEFAULT_HOST_CONCURRENCY))
+        semaphore = _host_semaphores[host]
+    # every metadata request runs inside a slot, so this is where requests are counted and timed per host
+    waiting_since = time.perf_counter()
+    with semaphore:
+        record_metric_timing('request_wait_seconds', time.perf_counter() - waiting_since, host=host)
+        with timed_metric('request_seconds', host=host, outcome='ok'):
+            yield
+
+def get_host_rate_limiter(
+    host : str
+) -> TokenBucket:
+    with _shared_state_lock:
+        if host not in _host_rate_limiters:
+            _host_rate_limiters[host] = TokenBucket(*HOST_RATE_LIMITS.get(host, DEFAULT_HOST_RATE_LIMIT))
+        return _host_rate_limiters[host]
+
+def check_host_breaker(
+    url : str
+) -> None:
+    # raises HostUnavailableError while the host is out of rotation. once the cooldown is over one request is let
+    # through as a trial, and the rest keep failing fast until it completes
+    host = urlsplit(url).hostname
+    with _shared_state_lock:
+        breaker = _host_breakers[host]
+        if breaker['open_until'] is None:
+            return
+        remaining = breaker['open_until'] - time.monotonic()
+        if remaining > 0:
+            record_metric_count('circuit_breaker_rejections_total', host=host)
+            raise HostUnavailableError(url, retry_after=remaining)
+        breaker['open_until'] = time.monotonic() + CIRCUIT_BREAKER_COOLDOWN
+
+def open_host_breaker(
+    host : str,
+    seconds : float,
+    reason : str
+) -> None:
+    # takes the host out of rotation for seconds, or keeps it out if it already is. call with _shared_state_lock held
+    breaker = _host_breakers[host]
+    if breaker['open_until'] is None:
+        print(f'WARNING: {host} {reason}, skipping it for {seconds:.0f} s')
+        record_metric_count('circuit_breaker_trips_total', host=host)
+    breaker['open_until'] = max(breaker['open_until'] or 0, time.monotonic() + seconds)
+
+def record_host_result(
+    url : str,
+    failed : bool,
+    retry_after : float = None
+) -> None:
+    # a retry_after longer than REQUEST_RETRY_MAX_DELAY takes the host out of rotation for that long straight away
+    host = urlsplit(url).hostname
+    with _shared_state_lock:
+        breaker = _host_breakers[host]
+        if not failed:
+            breaker['failures'] = 0
+            breaker['open_until'] = None
+            return
+        breaker['failures'] += 1
+        if retry_after is not None and retry_after > REQUEST_RETRY_MAX_DELAY:
+            open_host_breaker(host, retry_after, f'asked to retry after {retry_after:.0f} s')
+        elif breaker['failures'] >= CIRCUIT_BREAKER_FAILURES:
+            open_host_breaker(host, CIRCUIT_BREAKER_COOLDOWN, f'failed {breaker["failures"]} times in a row')
+
+def is_retryable_request_error(
+    error : Exception
+) -> bool:
+    # timeouts and dropped connections are OSErrors, including those raised through the arcgis sdk's requests
+    if isinstance(error, HostUnavailableError):
+        return False
+    if isinstance(error, ArcGISRestError):
+        return error.code in RETRYABLE_STATUS_CODES
+    return isinstance(error, (OSError, http.client.HTTPException))
+
+def get_retry_delay(
+    attempt : int,
+    retry_after : float = None
+) -> float:
+    # full jitter, so clients throttled together do not retry together. never more than REQUEST_RETRY_MAX_DELAY, since
+    # the caller may hold the url's lock while it sleeps, a longer retry_after fails the request instead
+    delay = random.uniform(0, min(REQUEST_RETRY_MAX_DELAY, REQUEST_RETRY_BASE_DELAY * 2 ** attempt))
+    return min(max(delay, retry_after or 0), REQUEST_RETRY_MAX_DELAY)
+
+def schedule_request(
+    url : str,
+    send
+):
+    # every metadata request goes through here: send() is called once the host's circuit breaker, rate budget and
+    # concurrency slot allow it, and retried on throttling responses, server errors and timeouts. anything else,
+    # and the last failed attempt, is raised to the caller
+    host = urlsplit(url).hostname
+    for attempt in range(REQUEST_RETRIES + 1):
+        check_host_breaker(url)
+        waited = get_host_rate_limiter(host).acquire()
+        if waited:
+            record_metric_timing('rate_limit_wait_seconds', waited, host=host)
+        try:
+            with host_request_slot(url):
+                result = send()
+        except Exception as e:
+            retryable = is_retryable_request_error(e)
+            retry_after = getattr(e, 'retry_after', None)
+            # an error response other than throttling or a server error still means the host is up
+            record_host_result(url, failed=retryable, retry_after=retry_after if retryable else None)
+            if not retryable or attempt == REQUEST_RETRIES or (retry_after or 0) > REQUEST_RETRY_MAX_DELAY:
+                raise
+            record_metric_count('request_retries_total', host=host)
+            time.sleep(get_retry_delay(attempt, retry_after))
+            continue
+        record_host_result(url, failed=False)
+        return result
+
+def url_lock(
+    url : str
+) -> threading.Lock:
+    # one lock per url, so concurrent lookups of the same layer or service wait for a single fetch
+    with _shared_state_lock:
+        return _url_locks[url]
+
+
+def get_service_url(
+    featurelayer_url : str
+) -> str:
+    # strips the layer id from the end of the url, e.g. .../FeatureServer/0 -> .../FeatureServer
+    return re.sub(r'/\d+/?$', '', featurelayer_url)
+
+def get_layer_cache_path(
+    featurelayer_url : str,
+    cache_dir : str = None
+) -> str:
+    # readable file name from the url, plus a short hash so urls that only differ in punctuation do not collide
+    slug = re.sub(r'[^A-Za-z0-9]+', '_', re.sub(r'^https?://', '', featurelayer_url)).strip('_')
+    digest = hashlib.sha1(featurelayer_url.encode('utf-8')).hexdigest()[:8]
+    return os.path.join(cache_dir or LAYER_CACHE_DIR, f'{slug}_{digest}.json')
+
+def get_field_profile_cache_dir(
+    cache_dir : str = None
+) -> str:
+    return os.path.join(cache_dir or LAYER_CACHE_DIR, FIELD_PROFILE_CACHE_SUBDIR)
+
+def read_layer_cache_entry(
+    featurelayer_url : str,
+    cache_dir : str = None
+) -> dict:
+    try:
+        with open(get_layer_cache_path(featurelayer_url, cache_dir=cache_dir), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_layer_cache_entry(
+    entry : dict,
+    cache_dir : str = None
+) -> None:
+    path = get_layer_cache_path(entry['url'], cache_dir=cache_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # writes to a temporary file first so an interrupted run never leaves a truncated entry behind
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=os.path.dirname(path), suffix='.tmp', delete=False) as f:
+        json.dump(entry, f)
+    os.replace(f.name, path)
+
+def clear_layer_cache(
+    on_disk : bool = False
+) -> None:
+    _layer_properties_cache.clear()
+    _service_properties_cache.clear()
+    _field_profile_cache.clear()
+    _item_owner_cache.clear()
+    _item_owners_not_found.clear()
+    _shard_plan_cache.clear()
+    for cache_dir in (LAYER_CACHE_DIR, get_field_profile_cache_dir()):
+        if on_disk and os.path.isdir(cache_dir):
+            for file_name in os.listdir(cache_dir):
+                if file_name.endswith('.json'):
+                    os.remove(os.path.join(cache_dir, file_name))
+
+def get_schema_last_edit_date(
+    properties : dict
+) -> int:
+    return (properties.get('editingInfo') or {}).get('schemaLastEditDate')
+
+def get_service_properties(
+    service_url : str,
+    gis : GIS
+) -> dict:
+    with url_lock(service_url):
+        if service_url not in _service_properties_cache:
+            if service_url.endswith('/FeatureServer'):
+                _service_properties_cache[service_url] = schedule_request(service_url, lambda: get_backend(gis).get_json(service_url))
+            else:
+                # map services do not report editingInfo, so there is nothing to revalidate against
+                _service_properties_cache[service_url] = {}
+    return _service_properties_cache[service_url]
+
+def is_layer_cache_entry_fresh(
+    entry : dict,
+    gis : GIS
+) -> bool:
+    if time.time() - entry['fetched_at'] < LAYER_CACHE_TTL:
+        return True
+
+    # past the ttl the entry is only kept if the service reports the same schema edit date as when it was cached.
+    # the service root is fetched once per run and shared by all of its sublayers
+    schema_last_edit_date = get_schema_last_edit_date(get_service_properties(get_service_url(entry['url']), gis=gis))
+    if schema_last_edit_date is None or schema_last_edit_date != entry['schema_last_edit_date']:
+        return False
+
+    entry['fetched_at'] = time.time()
+    write_layer_cache_entry(entry)
+    return True
+
+def get_cached_featurelayer_properties(
+    featurelayer_url : str,
+    gis : GIS
+) -> dict:
+    # returns the layer's properties from the in-process memo or a still valid disk entry, otherwise None
+    if featurelayer_url in _layer_properties_cache:
+        record_metric_count('cache_lookups_total', cache='layer', result='memory')
+        return _layer_properties_cache[featurelayer_url]
+
+    if OFFLINE_SNAPSHOT_DIR:
+        # snapshots never expire, they are regenerated explicitly
+        entry = read_layer_cache_entry(featurelayer_url, cache_dir=OFFLINE_SNAPSHOT_DIR)
+        if entry is None:
+            raise FileNotFoundError(f"No saved schema snapshot for '{featurelayer_url}' in '{OFFLINE_SNAPSHOT_DIR}'")
+        record_metric_count('cache_lookups_total', cache='layer', result='snapshot')
+        _layer_properties_cache[featurelayer_url] = entry['properties']
+        return entry['properties']
+
+    entry = read_layer_cache_entry(featurelayer_url)
+    if entry is None or not is_layer_cache_entry_fresh(entry, gis=gis):
+        record_metric_count('cache_lookups_total', cache='layer', result='miss' if entry is None else 'stale')
+        return None
+
+    record_metric_count('cache_lookups_total', cache='layer', result='disk')
+    _layer_properties_cache[featurelayer_url] = entry['properties']
+    return entry['properties']
+
+def trim_featurelayer_properties(
+    properties : dict
+) -> dict:
+    properties = {key: value for key, value in properties.items() if key in LAYER_PROPERTY_KEYS}
+    if properties.get('fields'):
+        properties['fields'] = [{key: value for key, value in field.items() if key in FIELD_PROPERTY_KEYS} for field in properties['fields']]
+    return properties
+
+def store_featurelayer_properties(
+    featurelayer_url : str,
+    properties : dict,
+    gis : GIS
+) -> dict:
+    properties = trim_featurelayer_properties(properties)
+    # records the service level schema edit date, since that is what later revalidations compare against. the layer
+    # reports its own date, which can differ, so the service root is fetched once per run and shared by its sublayers.
+    # map services have no service level date and keep the layer's
+    schema_last_edit_date = get_schema_last_edit_date(get_service_properties(get_service_url(featurelayer_url), gis=gis) or properties)
+    write_layer_cache_entry({
+        'url': featurelayer_url,
+        'fetched_at': time.time(),
+        'schema_last_edit_date': schema_last_edit_date,
+        'portal_url': get_backend(gis).url,
+        'properties': properties
+    })
+    _layer_properties_cache[featurelayer_url] = properties
+    return properties
+
+def get_featurelayer_properties(
+    featurelayer_url : str,
+    gis : GIS,
+    refresh : bool = False
+) -> dict:
+    if not refresh and featurelayer_url in _layer_properties_cache:
+        record_metric_count('cache_lookups_total', cache='layer', result='memory')
+        return _layer_properties_cache[featurelayer_url]
+
+    with url_lock(featurelayer_url):
+        # another thread may have fetched the layer while this one waited on the lock
+        properties = None if refresh and not OFFLINE_SNAPSHOT_DIR else get_cached_featurelayer_properties(featurelayer_url, gis=gis)
+        if properties is None:
+            properties = schedule_request(featurelayer_url, lambda: get_backend(gis).get_json(featurelayer_url))
+            properties = store_featurelayer_properties(featurelayer_url, properties, gis=gis)
+        return properties
+
+def fetch_service_layer_properties(
+    service_url : str,
+    featurelayer_urls : list,
+    gis : GIS
+) -> None:
+    # pulls the schema of every layer and table in the service with a single /layers request and caches the ones
+    # in featurelayer_urls. feature and map services both support it
+    response = schedule_request(service_url, lambda: get_backend(gis).get_json(f'{service_url}/layers'))
+
+    layer_urls = {}
+    for url in featurelayer_urls:
+        layer_id = re.search(r'/(\d+)/?$', url)
+        if layer_id:
+            layer_urls[int(layer_id.group(1))] = url
+    for properties in (response.get('layers') or []) + (response.get('tables') or []):
+        if properties.get('id') in layer_urls:
+            with url_lock(layer_urls[properties['id']]):
+                store_featurelayer_properties(layer_urls[properties['id']], properties, gis=gis)
+
+def prefetch_service_properties(
+    service_url : str,
+    featurelayer_urls : list,
+    gis : GIS
+) -> None:
+    stale_urls = [url for url in featurelayer_urls if get_cached_featurelayer_properties(url, gis=gis) is None]
+    # a single stale layer is cheaper to fetch on its own than the whole service
+    if len(stale_urls) > 1:
+        fetch_service_layer_properties(service_url, stale_urls, gis=gis)
+    # anything the batch did not return falls back to a per layer request
+    for url in featurelayer_urls:
+        get_featurelayer_properties(url, gis=gis)
+
+def prefetch_featurelayer_properties(
+    featurelayer_urls : list,
+    gis : GIS,
+    max_workers : int = None,
+    skip_failed : bool = False
+) -> list:
+    # fetches every layer's properties concurrently, grouping sibling sublayers so each service is requested once.
+    # requests are still capped per host by schedule_request, so the pool only needs enough workers to keep every
+    # host busy. results are returned in the order of the urls. with skip_failed a service that cannot be fetched is
+    # reported and its layers are returned as None instead of raising
+    services = defaultdict(list)
+    for url in dict.fromkeys(featurelayer_urls):
+        services[get_service_url(url)].append(url)
+
+    if max_workers is None:
+        hosts = {urlsplit(url).hostname for url in services}
+        max_workers = max(1, min(len(services), sum(HOST_CONCURRENCY.get(host, DEFAULT_HOST_CONCURRENCY) for host in hosts)))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {service_url: executor.submit(prefetch_service_properties, service_url, urls, gis) for service_url, urls in services.items()}
+        failed = set()
+        for service_url, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                if not skip_failed:
+                    raise
+                print(f"WARNING: Could not fetch '{service_url}': {e!r}")
+                failed.add(service_url)
+
+    return [None if get_service_url(url) in failed else get_featurelayer_properties(url, gis=gis) for url in featurelayer_urls]
+
+def save_featurelayer_snapshots(
+    featurelayer_urls : list,
+    snapshot_dir : str,
+    gis : GIS
+) -> None:
+    # saves each layer's cached properties to snapshot_dir, which can then be used as OFFLINE_SNAPSHOT_DIR to render
+    # the ddl without credentials, e.g. in ci
+    prefetch_featurelayer_properties(featurelayer_urls, gis=gis)
+    for url in featurelayer_urls:
+        entry = read_layer_cache_entry(url)
+        if entry is None:
+            # the on-disk entry can be missing if the cache directory was cleared mid run
+            entry = {'url': url, 'fetched_at': time.time(), 'schema_last_edit_date': None, 'portal_url': get_backend(gis).url,
+                     'properties': get_featurelayer_properties(url, gis=gis)}
+        write_layer_cache_entry(entry, cache_dir=snapshot_dir)
+        # field profiles are not fetched for the snapshot, only kept when the layer was already profiled
+        profile_entry = read_layer_cache_entry(url, cache_dir=get_field_profile_cache_dir())
+        if profile_entry is not None:
+            write_layer_cache_entry(profile_entry, cache_dir=get_field_profile_cache_dir(snapshot_dir))
+    # so is every item owner looked up so far, which lets offline runs fill in the secret names
+    if _item_owner_cache:
+        save_item_owners(dict(_item_owner_cache), cache_dir=snapshot_dir)
+
+def set_offline_mode(
+    snapshot_dir : str
+) -> None:
+    # switches the module to read only from the snapshots in snapshot_dir. passing None goes back online
+    global OFFLINE_SNAPSHOT_DIR
+    OFFLINE_SNAPSHOT_DIR = snapshot_dir
+    clear_layer_cache()
+
+def get_portal_url(
+    featurelayer_url : str,
+    gis : GIS
+) -> str:
+    # offline, the portal url comes from the snapshot so that no sign in is needed
+    if OFFLINE_SNAPSHOT_DIR:
+        entry = read_layer_cache_entry(featurelayer_url, cache_dir=OFFLINE_SNAPSHOT_DIR)
+        if entry is not None and entry.get('portal_url'):
+            return entry['portal_url']
+    return get_backend(gis).url
+
+def get_item_owner_cache_path(
+    cache_dir : str = None
+) -> str:
+    return os.path.join(cache_dir or OFFLINE_SNAPSHOT_DIR or LAYER_CACHE_DIR, 'item_owners.json')
+
+def save_item_owners(
+    item_owners : dict,
+    cache_dir : str = None
+) -> None:
+    path = get_item_owner_cache_path(cache_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=os.path.dirname(path), suffix='.tmp', delete=False) as f:
+        json.dump(item_owners, f, indent=2, sort_keys=True)
+    os.replace(f.name, path)
+
+def prefetch_item_owners(
+    item_ids : list,
+    gis : GIS
+) -> dict:
+    # returns {item id: owner} for the given ids, searching the portal only for the ids that are not cached yet,
+    # ITEM_SEARCH_BATCH_SIZE ids per request. ids the portal does not return (deleted, or not shared with the signed
+    # in user) map to None and are searched again next run, not again this run. so do the ids of a search that
+    # fails, which is reported, so that the layers fall back to the placeholder secret name instead of failing.
+    # offline, only the snapshot's owners are used
+    item_ids = [item_id for item_id in dict.fromkeys(item_ids) if item_id]
+    with _shared_state_lock:
+        if not _item_owner_cache:
+            try:
+                with open(get_item_owner_cache_path(), encoding='utf-8') as f:
+                    _item_owner_cache.update(json.load(f))
+            except (OSError, ValueError):
+                pass
+        missing = [item_id for item_id in item_ids if item_id not in _item_owner_cache and item_id not in _item_owners_not_found]
+
+    if missing and not OFFLINE_SNAPSHOT_DIR:
+        backend = get_backend(gis)
+        search_url = f"{backend.url.rstrip('/')}/sharing/rest/search"
+        for start in range(0, len(missing), ITEM_SEARCH_BATCH_SIZE):
+            batch = missing[start:start + ITEM_SEARCH_BATCH_SIZE]
+            try:
+                response = schedule_request(search_url, lambda: backend.get_json(search_url, {'q': ' OR '.join(f'id:{item_id}' for item_id in batch), 'num': len(batch)}))
+            except Exception as e:
+                print(f'WARNING: Could not look up the owners of items {batch}: {e!r}')
+                response = {}
+            with _shared_state_lock:
+                for result in response.get('results') or []:
+                    _item_owner_cache[result['id']] = result['owner']
+                _item_owners_not_found.update(item_id for item_id in batch if item_id not in _item_owner_cache)
+        with _shared_state_lock:
+            if any(item_id in _item_owner_cache for item_id in missing):
+                save_item_owners(dict(_item_owner_cache))
+
+    return {item_id: _item_owner_cache.get(item_id) for item_id in item_ids}
+
+def get_owner_secret_name(
+    owner : str
+) -> str:
+    return OWNER_SECRET_NAMES.get(owner, f"arcgisonline-{owner.replace('.', '')}")
 
 def get_featurelayer_fields(
     featurelayer_url : str,
     gis : GIS
 ) -> list:
-    return FeatureLayer(featurelayer_url, gis=gis).properties['fields']
+    return get_featurelayer_properties(featurelayer_url, gis=gis)['fields']
 
 def get_featurelayer_type(
     featurelayer_url : str,
     gis : GIS
-) -> list:
-    return FeatureLayer(featurelayer_url, gis=gis).properties['type']
+) -> str:
+    return get_featurelayer_properties(featurelayer_url, gis=gis)['type']
 
 def get_field_names(
     fields : list
@@ -52,11 +1037,238 @@ def get_featurelayer_field_names(
 ) -> str:
     return ', '.join([field['name'] for field in get_featurelayer_fields(featurelayer_url=featurelayer_url, gis=gis) if field['name'] not in IGNORED_FIELDS])
 
+def get_field_profile_statistics(
+    properties : dict
+) -> list:
+    # (field name, profile key, outStatistics definition) for every field that can be profiled. string lengths need
+    # sql expressions in outStatistics, which hosted layers support but many map services do not
+    if not properties.get('supportsStatistics', True):
+        return []
+    supports_expressions = (properties.get('advancedQueryCapabilities') or {}).get('supportsOutFieldSQLExpression', False)
+    ignored_fields = set(IGNORED_FIELDS)
+    statistics = []
+    for field in properties['fields']:
+        if field['name'] in ignored_fields:
+            continue
+        if field['type'] == 'esriFieldTypeString' and supports_expressions:
+            statistics.append((field['name'], 'max_length', {'statisticType': 'max', 'onStatisticField': f"CHAR_LENGTH({field['name']})"}))
+        elif field['type'] in SILVER_NUMERIC_TYPES:
+            statistics.append((field['name'], 'min', {'statisticType': 'min', 'onStatisticField': field['name']}))
+            statistics.append((field['name'], 'max', {'statisticType': 'max', 'onStatisticField': field['name']}))
+    return statistics
+
+def fetch_featurelayer_profile(
+    featurelayer_url : str,
+    gis : GIS
+) -> dict:
+    # runs the statistics as a few batched outStatistics queries, posted since a batch is several kilobytes, more than
+    # a web adaptor accepts in a query string. the output names are positional so long or oddly cased field names
+    # never collide, and a batch the server rejects only leaves its fields unprofiled
+    statistics = get_field_profile_statistics(get_featurelayer_properties(featurelayer_url, gis=gis))
+    profile = defaultdict(dict)
+    for start in range(0, len(statistics), FIELD_PROFILE_STATISTICS_PER_REQUEST):
+        batch = statistics[start:start + FIELD_PROFILE_STATISTICS_PER_REQUEST]
+        out_statistics = [{**definition, 'outStatisticFieldName': f'stat_{i}'} for i, (_, _, definition) in enumerate(batch)]
+        try:
+            response = schedule_request(featurelayer_url, lambda: get_backend(gis).post_json(f"{featurelayer_url.rstrip('/')}/query", {
+                'where': '1=1',
+                'outStatistics': json.dumps(out_statistics),
+                'returnGeometry': 'false'
+            }))
+        except ArcGISRestError as e:
+            field_names = ', '.join(dict.fromkeys(field_name for field_name, _, _ in batch))
+            print(f"WARNING: Could not profile {field_names} of '{featurelayer_url}', they keep their declared sizes: {e}")
+            continue
+        if not response.get('features'):
+            continue
+        # some servers upper case the output names
+        attributes = {key.lower(): value for key, value in response['features'][0]['attributes'].items()}
+        for i, (field_name, key, _) in enumerate(batch):
+            if attributes.get(f'stat_{i}') is not None:
+                profile[field_name][key] = attributes[f'stat_{i}']
+    return dict(profile)
+
+def get_featurelayer_profile(
+    featurelayer_url : str,
+    gis : GIS,
+    refresh : bool = False
+) -> dict:
+    # the longest string ({'max_length': n}) and numeric range ({'min': x, 'max': y}) of each field, used to size the
+    # silver columns from the data instead of the declared lengths. fields without values are left out. offline,
+    # profiles are only read from the snapshots and an unprofiled layer returns an empty profile
+    if not refresh and featurelayer_url in _field_profile_cache:
+        record_metric_count('cache_lookups_total', cache='profile', result='memory')
+        return _field_profile_cache[featurelayer_url]
+
+    with url_lock(f'{featurelayer_url}#profile'):
+        if OFFLINE_SNAPSHOT_DIR:
+            entry = read_layer_cache_entry(featurelayer_url, cache_dir=get_field_profile_cache_dir(OFFLINE_SNAPSHOT_DIR))
+            profile = entry['profile'] if entry else {}
+        else:
+            entry = None if refresh else read_layer_cache_entry(featurelayer_url, cache_dir=get_field_profile_cache_dir())
+            if entry is not None and time.time() - entry['fetched_at'] < FIELD_PROFILE_TTL:
+                record_metric_count('cache_lookups_total', cache='profile', result='disk')
+                profile = entry['profile']
+            else:
+                record_metric_count('cache_lookups_total', cache='profile', result='miss' if entry is None else 'stale')
+                profile = fetch_featurelayer_profile(featurelayer_url, gis=gis)
+                write_layer_cache_entry({'url': featurelayer_url, 'fetched_at': time.time(), 'profile': profile}, cache_dir=get_field_profile_cache_dir())
+        _field_profile_cache[featurelayer_url] = profile
+        return profile
+
+def prefetch_featurelayer_profiles(
+    featurelayer_urls : list,
+    gis : GIS,
+    max_workers : int = None
+) -> list:
+    # profiles every layer concurrently, after prefetching their properties. results are in the order of the urls
+    featurelayer_urls = list(featurelayer_urls)
+    prefetch_featurelayer_properties(featurelayer_urls, gis=gis, max_workers=max_workers)
+    if max_workers is None:
+        hosts = {urlsplit(url).hostname for url in featurelayer_urls}
+        max_workers = max(1, min(len(featurelayer_urls), sum(HOST_CONCURRENCY.get(host, DEFAULT_HOST_CONCURRENCY) for host in hosts)))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda url: get_featurelayer_profile(url, gis=gis), featurelayer_urls))
+
+# incremental stage rows only request features edited since this placeholder, which the ingest function replaces with
+# the highest edit date of the layer's previous ingest as 'YYYY-MM-DD HH:MI:SS' in utc. >= rather than > so edits
+# sharing the watermark's second are not missed, the silver merge drops the duplicates
+INCREMENTAL_WATERMARK_PLACEHOLDER = '{watermark}'
+
+def get_featurelayer_edit_tracking(
+    featurelayer_url : str,
+    gis : GIS
+) -> dict:
+    # what an incremental ingest and the silver merge need from a layer with editor tracking, or None when the layer
+    # does not track edit dates (e.g. map services), which then have to be pulled in full
+    properties = get_featurelayer_properties(featurelayer_url, gis=gis)
+    edit_fields_info = properties.get('editFieldsInfo') or {}
+    field_names = set(get_field_names(properties['fields']))
+    if edit_fields_info.get('editDateField') not in field_names:
+        return None
+
+    # globalids survive truncate and append while objectids do not, so they are the better merge key when present
+    key_field = next((field for field in (properties.get('globalIdField'), properties.get('objectIdField')) if field in field_names), 'OBJECTID')
+    return {
+        'edit_date_field': edit_fields_info['editDateField'],
+        'creation_date_field': edit_fields_info.get('creationDateField'),
+        'key_field': key_field,
+        'last_edit_date': (properties.get('editingInfo') or {}).get('lastEditDate')
+    }
+
+# the target number of features each function invocation extracts when a layer's stage parameters are sharded
+SHARD_RECORD_COUNT = 50000
+
+# plans by (url, records per shard), so the stage parameters and the silver procedure of a run agree on the shards
+_shard_plan_cache = {}
+
+def query_featurelayer(
+    featurelayer_url : str,
+    gis : GIS,
+    params : dict
+) -> dict:
+    return schedule_request(featurelayer_url, lambda: get_backend(gis).get_json(f"{featurelayer_url.rstrip('/')}/query", {'where': '1=1', **params}))
+
+def get_featurelayer_record_count(
+    featurelayer_url : str,
+    gis : GIS
+) -> int:
+    return query_featurelayer(featurelayer_url, gis=gis, params={'returnCountOnly': 'true'})['count']
+
+def get_featurelayer_page_size(
+    properties : dict
+) -> int:
+    # the most features a single query returns. the standard limit applies to queries without geometry on hosted
+    # layers, the smaller of the two is safe for both
+    record_counts = [count for count in (properties.get('maxRecordCount'), properties.get('standardMaxRecordCount')) if count]
+    return min(record_counts) if record_counts else 1000
+
+def get_featurelayer_shard_plan(
+    featurelayer_url : str,
+    gis : GIS,
+    records_per_shard : int = None
+) -> list:
+    # splits a layer into OBJECTID ranges of about records_per_shard features, returned as where clauses, so each
+    # range can be extracted by its own function invocation. layers that do not support pagination are extracted with
+    # one query per invocation, so their shards are capped at the page size. a layer that fits one shard gets ['1=1'].
+    # planning queries the layer's record count and objectids, which snapshots do not hold, so it fails offline
+    if (featurelayer_url, records_per_shard) not in _shard_plan_cache:
+        _shard_plan_cache[(featurelayer_url, records_per_shard)] = plan_featurelayer_shards(featurelayer_url, gis=gis, records_per_shard=records_per_shard)
+    return _shard_plan_cache[(featurelayer_url, records_per_shard)]
+
+def plan_featurelayer_shards(
+    featurelayer_url : str,
+    gis : GIS,
+    records_per_shard : int = None
+) -> list:
+    if OFFLINE_SNAPSHOT_DIR:
+        raise ValueError(f"Cannot plan the shards of '{featurelayer_url}' offline, render its stage parameters without sharded or online")
+    properties = get_featurelayer_properties(featurelayer_url, gis=gis)
+    supports_pagination = properties.get('supportsPagination') or (properties.get('advancedQueryCapabilities') or {}).get('supportsPagination', False)
+    page_size = get_featurelayer_page_size(properties)
+    records_per_shard = records_per_shard or SHARD_RECORD_COUNT
+    # shards are whole pages, so no invocation ends on a partial page it did not need
+    records_per_shard = max(page_size, records_per_shard // page_size * page_size) if supports_pagination else page_size
+
+    record_count = get_featurelayer_record_count(featurelayer_url, gis=gis)
+    if record_count <= records_per_shard:
+        return ['1=1']
+
+    object_id_field = properties.get('objectIdField') or 'OBJECTID'
+    shard_count = -(-record_count // records_per_shard)
+    if properties.get('supportsStatistics', True):
+        # objectids can have gaps, so ranges evenly split between the lowest and highest id are only about equal.
+        # the last range is open ended so features added since planning are still extracted
+        response = query_featurelayer(featurelayer_url, gis=gis, params={'outStatistics': json.dumps([
+            {'statisticType': 'min', 'onStatisticField': object_id_field, 'outStatisticFieldName': 'min_id'},
+            {'statisticType': 'max', 'onStatisticField': object_id_field, 'outStatisticFieldName': 'max_id'}
+        ])})
+        attributes = {key.lower(): value for key, value in response['features'][0]['attributes'].items()}
+        min_id, max_id = int(attributes['min_id']), int(attributes['max_id'])
+        width = -(-(max_id - min_id + 1) // shard_count)
+        bounds = [min_id + width * i for i in range(1, shard_count)]
+    else:
+        # without statistics the ids themselves are requested, which is not limited by maxRecordCount, and split
+        # into shards of exactly records_per_shard features
+        object_ids = sorted(query_featurelayer(featurelayer_url, gis=gis, params={'returnIdsOnly': 'true'})['objectIds'])
+        bounds = object_ids[records_per_shard::records_per_shard]
+
+    wheres = []
+    lower = None
+    for upper in bounds + [None]:
+        conditions = ([f'{object_id_field} >= {lower}'] if lower is not None else []) + ([f'{object_id_field} < {upper}'] if upper is not None else [])
+        wheres.append(' AND '.join(conditions))
+        lower = upper
+    return wheres
+
+@timed_generator
 def get_featurelayer_stage_parameters(
     featurelayer_url : str,
     gis : GIS,
-    name : str
+    name : str,
+    incremental : bool = False,
+    sharded : bool = False,
+    records_per_shard : int = None,
+    arrow_schema : bool = False,
+    item_id : str = None
 ) -> str:
+    # incremental filters the ingest to features edited since the previous ingest (see INCREMENTAL_WATERMARK_PLACEHOLDER)
+    # when the layer tracks edit dates. pair it with the incremental silver procedure, which merges the deltas.
+    # sharded emits one row per OBJECTID range of get_featurelayer_shard_plan, so a large layer is extracted by
+    # parallel invocations. every invocation stamps its own INGEST_TS, so the silver procedure has to be generated
+    # with sharded as well, which takes the newest ingest by its folder, shared by all the shards of a run, rather
+    # than by INGEST_TS. incremental rows are never sharded, a delta is small enough for one invocation.
+    # arrow_schema replaces the 'geojson_infer_schema' step with the layer's precomputed schema artifact at
+    # ARROW_SCHEMA_LOCATION (see write_featurelayer_arrow_schema), which has to be uploaded before the ingest runs.
+    # item_id fills in the owner's secret name, see prefetch_item_owners to look up many layers' owners at once
+    where = '1=1'
+    if incremental:
+        edit_tracking = get_featurelayer_edit_tracking(featurelayer_url, gis=gis)
+        if edit_tracking is None:
+            print(f"WARNING: The feature layer '{name}' does not track edit dates, so its stage parameters pull every feature")
+        else:
+            where = f"{edit_tracking['edit_date_field']} >= TIMESTAMP '{INCREMENTAL_WATERMARK_PLACEHOLDER}'".replace("'", "''")
 
     fields = get_featurelayer_field_names(featurelayer_url=featurelayer_url, gis=gis)
     if get_featurelayer_type(featurelayer_url=featurelayer_url, gis=gis) == 'Feature Layer':
@@ -65,71 +1277,62 @@ def get_featurelayer_stage_parameters(
     else:
         AZURE_FUNCTION_TRANSFORM_NAME = 'geojson_parquet'
         return_geometry = 'false'
+    schema_step = ARROW_SCHEMA_LOCATION.format(name=name) if arrow_schema else 'geojson_infer_schema'
+    wheres = get_featurelayer_shard_plan(featurelayer_url, gis=gis, records_per_shard=records_per_shard) if sharded and where == '1=1' else [where]
 
     # gets the base url and path for the feature service. the base url is the .com, .org, etc. domain and the path is everything after it
     service_base_url, service_path = re.match(r'(https?://[^/]+)(/.*)', featurelayer_url).groups()
     service_path = service_path[1:]
 
-    # TODO: gets the username of the owner of the feature layer item with the "." characters removed
-    # however, if the owner does not have a developer credential item, then provide a warning
+    owner = prefetch_item_owners([item_id], gis=gis).get(item_id) if item_id else None
+    secret_name = get_owner_secret_name(owner) if owner else 'arcgisonline-OWNER-CORRESPONDING-SECRET-NAME'
 
-    parameters = f'''
+    portal_url = get_portal_url(featurelayer_url, gis=gis).lower()
+    parameters = ''.join(f'''
     ('{name}',
         "gis-raw/{name}",
         '{service_base_url}', 
         '{service_path}',
-        '1=1',
+        '{where}',
         '{fields}',
         '{return_geometry}',
-        '{gis.url.lower()}',
-        'arcgisonline-OWNER-CORRESPONDING-SECRET-NAME',
+        '{portal_url}',
+        '{secret_name}',
         f"func-mds-python-flex-mc-dev",
-        'geojson_infer_schema',
+        '{schema_step}',
         '{AZURE_FUNCTION_TRANSFORM_NAME}'),
-'''
-    # prints warning to replace the owner's corresponding secret name bc that logic is not provided (yet)
-    print(f"WARNING: Replace 'arcgisonline-OWNER-CORRESPONDING-SECRET-NAME' with the correct secret name for the owner of the feature layer '{name}'")
+''' for where in wheres)
+    # prints warning to replace the owner's corresponding secret name when the owner could not be looked up
+    if owner is None:
+        print(f"WARNING: Replace 'arcgisonline-OWNER-CORRESPONDING-SECRET-NAME' with the correct secret name for the owner of the feature layer '{name}'")
     
     return parameters
 
-def get_featurelayer_bronzesqlfields(
-    featurelayer_url : str,
-    gis : GIS,
-    name : str
-) -> str:
-    fields = get_featurelayer_fields(featurelayer_url=featurelayer_url, gis=gis)
-    type_mappings = {
-        'esriFieldTypeString': lambda field: f"VARCHAR({field['length']})",
-        'esriFieldTypeSmallInteger': lambda field: 'INT',
-        'esriFieldTypeBigInteger': lambda field: 'BIGINT',
-        'esriFieldTypeInteger': lambda field: 'INT',
-        'esriFieldTypeOID': lambda field: 'INT',
-        'esriFieldTypeGlobalID': lambda field: "CHAR(36)",
-        'esriFieldTypeGUID': lambda field: "CHAR(36)",
-        'esriFieldTypeDate': lambda field: 'INT',
-        'esriFieldTypeDouble' : lambda field: "NUMERIC(38, 8)",
-        'esriFieldTypeFloat' : lambda field: "NUMERIC(12, 6)",
-        'esriFieldTypeSingle' : lambda field: "NUMERIC(12, 6)",
-        'esriFieldTypeBlob': lambda field: 'BINARY'
-    }
-    start_sql = f'''USE mds_ldw
-GO
-DROP EXTERNAL TABLE bronze.B_GIS_{name.upper()}
-GO
-CREATE EXTERNAL TABLE bronze.B_GIS_{name.upper()}
-(
-'''
-    sql = ''
-    for field in fields:
-        if field['name'] not in IGNORED_FIELDS:
-            sql += '    ,[' + field['name'] + '] VARCHAR(8000)' + '''
-'''
-    sql = start_sql + '    ' + sql[5:-1] + f'''
-    ,[INGEST_FILE] VARCHAR(8000)
-    ,[INGEST_TS] VARCHAR(8000)'''
-    
-    if get_featurelayer_type(featurelayer_url=featurelayer_url, gis=gis) == 'Feature Layer':
-        sql = sql + f'''
+# the sql emitted for each field type is compiled once at import. the renderers below build each statement as a list
+# of parts joined at the end, instead of concatenating strings and trimming the leading separator
+
+# declared bronze types for each esri field type when the bronze ddl is typed, see get_featurelayer_bronzesqlfields.
+# they follow the parquet physical types the transform writes from geojson rather than the esri types: integers and
+# dates arrive as int64, guids keep their braces, and string lengths are in characters while VARCHAR lengths are utf-8
+# bytes. a nullable integer or date column is int64 in files where it happens to be filled and double in files where
+# it has a null, so no single numeric type reads every file and those fields keep the string fallback
+BRONZE_TYPE_MAPPINGS = {
+    'esriFieldTypeString': lambda field: f"VARCHAR({min(max(field.get('length') or 1, 1) * 4, 8000)})",
+    'esriFieldTypeSmallInteger': lambda field: BRONZE_FALLBACK_TYPE if field.get('nullable', True) else 'BIGINT',
+    'esriFieldTypeBigInteger': lambda field: BRONZE_FALLBACK_TYPE if field.get('nullable', True) else 'BIGINT',
+    'esriFieldTypeInteger': lambda field: BRONZE_FALLBACK_TYPE if field.get('nullable', True) else 'BIGINT',
+    'esriFieldTypeOID': lambda field: 'BIGINT',
+    'esriFieldTypeGlobalID': lambda field: "VARCHAR(38)",
+    'esriFieldTypeGUID': lambda field: "VARCHAR(38)",
+    'esriFieldTypeDate': lambda field: BRONZE_FALLBACK_TYPE if field.get('nullable', True) else 'BIGINT',
+    'esriFieldTypeDouble' : lambda field: "FLOAT",
+    'esriFieldTypeFloat' : lambda field: "FLOAT",
+    'esriFieldTypeSingle' : lambda field: "FLOAT",
+}
+# used for any field type without a mapping, and the type every column had before typed bronze
+BRONZE_FALLBACK_TYPE = 'VARCHAR(8000)'
+
+BRONZE_FEATURE_LAYER_COLUMNS = '''
     ,[GEOMWKB] VARBINARY(MAX)
     ,[GEOMWKT] VARCHAR(MAX)
     ,[X] FLOAT
@@ -138,39 +1341,251 @@ CREATE EXTERNAL TABLE bronze.B_GIS_{name.upper()}
     ,[LATITUDE] FLOAT
     ,[AREA] FLOAT
     ,[LENGTH] FLOAT
-    ,[GEOMTYPE] VARCHAR(8000)
-    ,[COUNCIL2021] VARCHAR(8000)
-    ,[COUNCIL2021_DOMINANT] VARCHAR(8000)
-    ,[COUNCIL2021_AREAS] VARCHAR(8000)
-    ,[LEGISLATIVE2022] VARCHAR(8000)
-    ,[LEGISLATIVE2022_DOMINANT] VARCHAR(8000)
-    ,[LEGISLATIVE2022_AREAS] VARCHAR(8000)
-    ,[CONGRESS2021] VARCHAR(8000)
-    ,[CONGRESS2021_DOMINANT] VARCHAR(8000)
-    ,[CONGRESS2021_AREAS] VARCHAR(8000)
-    ,[PARKPOLICEBEAT] VARCHAR(8000)
-    ,[PARKPOLICEBEAT_DOMINANT] VARCHAR(8000)
-    ,[PARKPOLICEBEAT_AREAS] VARCHAR(8000)
-    ,[AGRESERVE] VARCHAR(8000)
-    ,[AGRESERVE_DOMINANT] VARCHAR(8000)
-    ,[AGRESERVE_AREAS] VARCHAR(8000)
-    ,[REGIONALSERVICECENTER] VARCHAR(8000)
-    ,[REGIONALSERVICECENTER_DOMINANT] VARCHAR(8000)
-    ,[REGIONALSERVICECENTER_AREAS] VARCHAR(8000)
-    ,[CENSUSTRACT2020] VARCHAR(8000)
-    ,[CENSUSTRACT2020_DOMINANT] VARCHAR(8000)
-    ,[CENSUSTRACT2020_AREAS] VARCHAR(8000)
-    ,[CENSUSTRACT2010] VARCHAR(8000)
-    ,[CENSUSTRACT2010_DOMINANT] VARCHAR(8000)
-    ,[CENSUSTRACT2010_AREAS] VARCHAR(8000)
-    ,[GEOM_PARK_CODE] VARCHAR(8000)
-    ,[GEOM_PARK_CODE_DOMINANT] VARCHAR(8000)
-    ,[GEOM_PARK_CODE_AREAS] VARCHAR(8000)
-    ,[GEOM_PARK_CODE_NEAREST] VARCHAR(8000)
-    ,[GEOM_PARK_CODE_NEARESTDISTANCE] FLOAT
-    ,[GEOM_PARK_CODE_NEARESTAREAS] VARCHAR(8000)'''
-
-    sql = sql + f'''
+    ,[GEOMTYPE] VARCHAR(8000)'''
+
+# the same columns sized like the silver casts, for typed bronze
+BRONZE_TYPED_FEATURE_LAYER_COLUMNS = '''
+    ,[GEOMWKB] VARBINARY(MAX)
+    ,[GEOMWKT] VARCHAR(MAX)
+    ,[X] FLOAT
+    ,[Y] FLOAT
+    ,[LONGITUDE] FLOAT
+    ,[LATITUDE] FLOAT
+    ,[AREA] FLOAT
+    ,[LENGTH] FLOAT
+    ,[GEOMTYPE] VARCHAR(30)'''
+
+# the folder levels under /bronze/gis-bronze/<name>/ that the ingest writes, outermost first. each ingest writes its
+# own folder at the innermost level, so the path through all the levels identifies an ingest, and the names sort
+# chronologically. the partitioned bronze views expose each level as a column (see render_bronze_view_sql) and the
+# latest ingest silver reads the newest of these paths (see render_latest_ingest_silver_table)
+BRONZE_PARTITION_COLUMNS = ['INGEST_DATE', 'INGEST_TIME']
+
+SILVER_FIELD_TEMPLATES = {
+    'esriFieldTypeString': "CAST([{name}] AS VARCHAR({length})) AS [{clean_name}]",
+    'esriFieldTypeSmallInteger': "CAST(CAST([{name}] AS FLOAT) AS INT) AS [{clean_name}]",
+    'esriFieldTypeBigInteger': "CAST(CAST([{name}] AS FLOAT) AS BIGINT) AS [{clean_name}]",
+    'esriFieldTypeInteger': "CAST(CAST([{name}] AS FLOAT) AS INT) AS [{clean_name}]",
+    'esriFieldTypeOID': "CAST([{name}] AS INT) AS [{clean_name}]",
+    'esriFieldTypeGlobalID': "CAST([{name}] AS CHAR(36)) AS [{clean_name}]",
+    'esriFieldTypeGUID': "CAST([{name}] AS CHAR(36)) AS [{clean_name}]",
+    'esriFieldTypeDate': "DATEADD(S, CAST([{name}] AS FLOAT)/1000, '1970-01-01') AT TIME ZONE 'UTC' AT TIME ZONE 'Eastern Standard Time' AS [{clean_name}]",
+    'esriFieldTypeDouble' : "CAST([{name}] AS NUMERIC(38, 8)) AS [{clean_name}]",
+    'esriFieldTypeFloat' : "CAST([{name}] AS NUMERIC(12, 6)) AS [{clean_name}]",
+    'esriFieldTypeSingle' : "CAST([{name}] AS NUMERIC(12, 6)) AS [{clean_name}]",
+    'esriFieldTypeBlob': "CAST([{name}] AS BINARY) AS [{clean_name}]"
+}
+
+# the (precision, scale) of the NUMERIC casts above. a profiled field keeps the scale and narrows the precision to the
+# integer digits its values need, see size_fields_from_profile
+SILVER_NUMERIC_TYPES = {
+    'esriFieldTypeDouble': (38, 8),
+    'esriFieldTypeFloat': (12, 6),
+    'esriFieldTypeSingle': (12, 6),
+}
+SILVER_PROFILED_NUMERIC_TEMPLATE = "CAST([{name}] AS NUMERIC({precision}, {scale})) AS [{clean_name}]"
+
+# room left above the profiled values, so later edits that are a bit longer or larger still fit: string lengths are
+# multiplied by PROFILE_LENGTH_HEADROOM and rounded up to a multiple of 10, numerics get extra integer digits
+PROFILE_LENGTH_HEADROOM = 2
+PROFILE_NUMERIC_HEADROOM_DIGITS = 2
+
+SILVER_FEATURE_LAYER_COLUMNS = '''
+    ,[GEOMWKB]
+    ,[GEOMWKT]
+    ,ROUND([X], 8) AS [X]
+    ,ROUND([Y], 8) AS [Y]
+    ,ROUND([LONGITUDE], 8) AS [LONGITUDE]
+    ,ROUND([LATITUDE], 8) AS [LATITUDE]
+    ,ROUND([LENGTH], 4) AS [LENGTH]
+    ,ROUND([AREA], 4) AS [AREA]
+    ,CAST([GEOMTYPE] AS VARCHAR(30)) AS [GEOMTYPE]'''
+
+# the geolookup columns the locations transform can add to a feature layer, as (column suffix, silver type) per
+# lookup. they are rendered for the bronze ddl, the typed bronze ddl and the silver casts from this one registry, see
+# render_geolookup_columns. lookups that are not listed get the standard area columns
+GEOLOOKUP_AREA_COLUMNS = [
+    ('', 'VARCHAR(1020)'),
+    ('_DOMINANT', 'VARCHAR(255)'),
+    ('_AREAS', 'VARCHAR(MAX)'),
+]
+GEOLOOKUPS = {
+    'COUNCIL2021': GEOLOOKUP_AREA_COLUMNS,
+    'LEGISLATIVE2022': GEOLOOKUP_AREA_COLUMNS,
+    'CONGRESS2021': GEOLOOKUP_AREA_COLUMNS,
+    'PARKPOLICEBEAT': GEOLOOKUP_AREA_COLUMNS,
+    'AGRESERVE': GEOLOOKUP_AREA_COLUMNS,
+    'REGIONALSERVICECENTER': GEOLOOKUP_AREA_COLUMNS,
+    'CENSUSTRACT2020': GEOLOOKUP_AREA_COLUMNS,
+    'CENSUSTRACT2010': GEOLOOKUP_AREA_COLUMNS,
+    'GEOM_PARK_CODE': [
+        ('', 'VARCHAR(150)'),
+        ('_DOMINANT', 'VARCHAR(30)'),
+        ('_AREAS', 'VARCHAR(MAX)'),
+        ('_NEAREST', 'VARCHAR(30)'),
+        ('_NEARESTDISTANCE', 'FLOAT'),
+        ('_NEARESTAREAS', 'VARCHAR(MAX)'),
+    ],
+}
+# silver has always cast REGIONALSERVICECENTER before AGRESERVE while bronze declares them the other way round, so
+# the silver casts follow this order. lookups that are not listed go last, in registry order
+SILVER_GEOLOOKUP_ORDER = [
+    'COUNCIL2021',
+    'LEGISLATIVE2022',
+    'CONGRESS2021',
+    'PARKPOLICEBEAT',
+    'REGIONALSERVICECENTER',
+    'AGRESERVE',
+    'CENSUSTRACT2020',
+    'CENSUSTRACT2010',
+    'GEOM_PARK_CODE',
+]
+
+RENAME_FIELDS = {
+    'SIZE_': 'SIZE',
+    'CREATED_DATE': 'CreationDate',
+    'UPDATED_DATE': 'EditDate',
+    'CREATED_USER': 'Creator',
+    'UPDATED_USER': 'Editor'
+}
+
+
+@lru_cache(maxsize=None)
+def clean_field_name(name : str) -> str:
+    clean_name = reduce(lambda a, kv: a.replace(*kv), RENAME_FIELDS.items(), name)
+    clean_name = clean_name.upper()
+
+    return clean_name
+
+def compile_silver_field_renderer(
+    template : str
+):
+    render = template.format
+    if '{length}' in template:
+        return lambda field: render(name=field['name'], clean_name=clean_field_name(field['name']), length=field['length'] if field['length'] < 8000 else 'MAX')
+    return lambda field: render(name=field['name'], clean_name=clean_field_name(field['name']))
+
+SILVER_FIELD_RENDERERS = {field_type: compile_silver_field_renderer(template) for field_type, template in SILVER_FIELD_TEMPLATES.items()}
+
+def select_geolookups(
+    geolookups : list = None
+) -> tuple:
+    # the selected lookups in registry order, so the column order does not depend on how a selection was written.
+    # None selects every lookup, which is what feature layers got before lookups could be selected
+    if geolookups is None:
+        return tuple(GEOLOOKUPS)
+    unknown = [name for name in geolookups if name not in GEOLOOKUPS]
+    if unknown:
+        raise ValueError(f'Unknown geolookups {unknown}, add them to GEOLOOKUPS first')
+    return tuple(name for name in GEOLOOKUPS if name in geolookups)
+
+def get_geolookup_columns(
+    geolookups : list = None
+) -> list:
+    # (column name, silver type) of every column the selected lookups add, which is also what the transform has to write
+    return [(f'{name}{suffix}', column_type) for name in select_geolookups(geolookups) for suffix, column_type in GEOLOOKUPS[name]]
+
+@lru_cache(maxsize=None)
+def render_geolookup_columns(
+    geolookups : tuple,
+    target : str
+) -> str:
+    # target is 'bronze' (everything VARCHAR(8000) except numbers), 'typed_bronze' or 'silver'. rendered once per
+    # selection and reused for every layer
+    if target == 'silver':
+        geolookups = sorted(geolookups, key=lambda name: SILVER_GEOLOOKUP_ORDER.index(name) if name in SILVER_GEOLOOKUP_ORDER else len(SILVER_GEOLOOKUP_ORDER))
+    columns = []
+    for name in geolookups:
+        for suffix, column_type in GEOLOOKUPS.get(name, GEOLOOKUP_AREA_COLUMNS):
+            column = f'{name}{suffix}'
+            if target == 'silver':
+                columns.append(f'ROUND([{column}], 4) AS [{column}]' if column_type == 'FLOAT' else f'CAST([{column}] AS {column_type}) AS [{column}]')
+            elif target == 'typed_bronze' or column_type == 'FLOAT':
+                columns.append(f'[{column}] {column_type}')
+            else:
+                columns.append(f'[{column}] VARCHAR(8000)')
+    return ''.join(f'\n    ,{column}' for column in columns)
+
+def render_profiled_numeric_field(
+    field : dict
+) -> str:
+    return SILVER_PROFILED_NUMERIC_TEMPLATE.format(name=field['name'], clean_name=clean_field_name(field['name']), precision=field['precision'], scale=field['scale'])
+
+def size_fields_from_profile(
+    fields : list,
+    profile : dict
+) -> list:
+    # copies of the fields with string lengths and numeric precisions taken from the profile. sizes only ever shrink,
+    # the declared length and the default precision stay the upper bounds
+    sized_fields = []
+    for field in fields:
+        field_profile = profile.get(field['name'])
+        if field_profile and field['type'] == 'esriFieldTypeString' and field_profile.get('max_length') is not None:
+            length = max(10, -(-int(field_profile['max_length']) * PROFILE_LENGTH_HEADROOM // 10) * 10)
+            field = {**field, 'length': min(length, field['length']) if field.get('length') else length}
+        elif field_profile and field['type'] in SILVER_NUMERIC_TYPES and field_profile.get('min') is not None and field_profile.get('max') is not None:
+            default_precision, scale = SILVER_NUMERIC_TYPES[field['type']]
+            integer_digits = len(str(int(max(abs(field_profile['min']), abs(field_profile['max']))))) + PROFILE_NUMERIC_HEADROOM_DIGITS
+            field = {**field, 'precision': min(default_precision, integer_digits + scale), 'scale': scale}
+        sized_fields.append(field)
+    return sized_fields
+
+def get_bronze_type(
+    field : dict,
+    physical_types : dict = None
+) -> str:
+    # a type given for the field in physical_types, e.g. from the parquet files, wins over the esri type mapping
+    if physical_types and field['name'] in physical_types:
+        return physical_types[field['name']]
+    mapping = BRONZE_TYPE_MAPPINGS.get(field['type'])
+    return mapping(field) if mapping else BRONZE_FALLBACK_TYPE
+
+def render_bronze_columns(
+    fields : list,
+    layer_type : str,
+    typed : bool = False,
+    physical_types : dict = None,
+    geolookups : list = None
+) -> str:
+    # the column definitions of the bronze external table, also used for the WITH clause of OPENROWSET reads. every
+    # column is VARCHAR(8000) unless typed, which declares each field from its metadata instead. feature layers also
+    # get the geometry columns and the geolookups selected by geolookups (see select_geolookups)
+    ignored_fields = set(IGNORED_FIELDS)
+    if typed:
+        columns = [f"[{field['name']}] {get_bronze_type(field, physical_types)}" for field in fields if field['name'] not in ignored_fields]
+    else:
+        columns = [f"[{field['name']}] VARCHAR(8000)" for field in fields if field['name'] not in ignored_fields]
+    parts = [
+        '    ',
+        '\n    ,'.join(columns),
+        '''
+    ,[INGEST_FILE] VARCHAR(8000)
+    ,[INGEST_TS] VARCHAR(8000)'''
+    ]
+    if layer_type == 'Feature Layer':
+        parts.append(BRONZE_TYPED_FEATURE_LAYER_COLUMNS if typed else BRONZE_FEATURE_LAYER_COLUMNS)
+        parts.append(render_geolookup_columns(select_geolookups(geolookups), 'typed_bronze' if typed else 'bronze'))
+    return ''.join(parts)
+
+def render_bronze_sql(
+    fields : list,
+    layer_type : str,
+    name : str,
+    typed : bool = False,
+    physical_types : dict = None,
+    geolookups : list = None
+) -> str:
+    parts = [
+        f'''USE mds_ldw
+GO
+DROP EXTERNAL TABLE bronze.B_GIS_{name.upper()}
+GO
+CREATE EXTERNAL TABLE bronze.B_GIS_{name.upper()}
+(
+''',
+        render_bronze_columns(fields, layer_type, typed=typed, physical_types=physical_types, geolookups=geolookups)
+    ]
+    parts.append(f'''
 )  
 WITH (
     LOCATION = '/bronze/gis-bronze/{name}/**',
@@ -180,106 +1595,289 @@ WITH (
 GO
 
 -- SELECT TOP 1 * FROM bronze.B_GIS_{name.upper()}
+    ''')
+    return ''.join(parts)
+
+def render_bronze_view_sql(
+    fields : list,
+    layer_type : str,
+    name : str,
+    partition_columns : list = None,
+    typed : bool = False,
+    physical_types : dict = None,
+    geolookups : list = None
+) -> str:
+    # a view over OPENROWSET exposing each wildcard folder level under the layer's bronze location as a column, so
+    # queries filtering on them only open the matching folders. FORMAT = 'PARQUET' reads the same files that the
+    # raw_ion_parquet external file format describes for the external table
+    partition_columns = BRONZE_PARTITION_COLUMNS if partition_columns is None else partition_columns
+    wildcards = render_ingest_folder_wildcards(partition_columns)
+    partition_selection = ''.join(f'\n    ,[r].filepath({i}) AS [{column}]' for i, column in enumerate(partition_columns, start=1))
+    return f'''USE mds_ldw
+GO
+CREATE OR ALTER VIEW bronze.V_GIS_{name.upper()}
+AS
+SELECT
+    [r].*{partition_selection}
+FROM OPENROWSET(
+    BULK '/bronze/gis-bronze/{name}/{wildcards}**',
+    DATA_SOURCE = 'mds_ldw_source',
+    FORMAT = 'PARQUET'
+) WITH (
+{render_bronze_columns(fields, layer_type, typed=typed, physical_types=physical_types, geolookups=geolookups)}
+) AS [r]
+GO
+
+-- SELECT TOP 1 * FROM bronze.V_GIS_{name.upper()} WHERE [{partition_columns[0]}] = (SELECT MAX([{partition_columns[0]}]) FROM bronze.V_GIS_{name.upper()})
     '''
 
-    return sql
+def render_ingest_folder_wildcards(
+    partition_columns : list = None
+) -> str:
+    # one wildcard folder per level of the ingest folder layout, e.g. */*/
+    return ''.join('*/' for _ in (BRONZE_PARTITION_COLUMNS if partition_columns is None else partition_columns))
 
+def render_ingest_folder_path(
+    partition_columns : list = None
+) -> str:
+    # the expression of an OPENROWSET read over render_ingest_folder_wildcards that gives the ingest folder of each
+    # row, relative to the layer's bronze location
+    levels = BRONZE_PARTITION_COLUMNS if partition_columns is None else partition_columns
+    return " + '/' + ".join(f'[r].filepath({i})' for i in range(1, len(levels) + 1))
 
-def clean_field_name(name : str) -> str:
-    rename_fields = {
-        'SIZE_': 'SIZE',
-        'CREATED_DATE': 'CreationDate',
-        'UPDATED_DATE': 'EditDate',
-        'CREATED_USER': 'Creator',
-        'UPDATED_USER': 'Editor'
-    }
-    clean_name = reduce(lambda a, kv: a.replace(*kv), rename_fields.items(), name)
-    clean_name = clean_name.upper()
+def render_silver_fields(
+    fields : list,
+    layer_type : str,
+    profile : dict = None,
+    geolookups : list = None
+) -> str:
+    ignored_fields = set(IGNORED_FIELDS)
+    if profile:
+        columns = [
+            (render_profiled_numeric_field if 'precision' in field else SILVER_FIELD_RENDERERS[field['type']])(field)
+            for field in size_fields_from_profile(fields, profile) if field['name'] not in ignored_fields and field['type'] != 'esriFieldTypeGeometry'
+        ]
+    else:
+        columns = [SILVER_FIELD_RENDERERS[field['type']](field) for field in fields if field['name'] not in ignored_fields and field['type'] != 'esriFieldTypeGeometry']
+    parts = [
+        '    ',
+        '\n    ,'.join(columns),
+        '''
+    ,[INGEST_TS]
+    ,[INGEST_FILE]'''
+    ]
+    if layer_type == 'Feature Layer':
+        parts.append(SILVER_FEATURE_LAYER_COLUMNS)
+        parts.append(render_geolookup_columns(select_geolookups(geolookups), 'silver'))
+    return ''.join(parts)
 
-    return clean_name
+@timed_generator
+def get_featurelayer_bronzesqlfields(
+    featurelayer_url : str,
+    gis : GIS,
+    name : str,
+    typed : bool = False,
+    physical_types : dict = None,
+    geolookups : list = None
+) -> str:
+    # typed declares each column from the field metadata (BRONZE_TYPE_MAPPINGS) instead of VARCHAR(8000), which keeps
+    # serverless memory grants small. nullable integer and date fields stay VARCHAR(8000) even when typed, since their
+    # parquet type changes from file to file. physical_types maps field names to the type to declare instead, e.g. FLOAT
+    # for such a field when the ingest writes it with an arrow schema artifact. geolookups limits the geolookup columns of a
+    # feature layer to the listed GEOLOOKUPS, all of them by default
+    return render_bronze_sql(
+        fields=get_featurelayer_fields(featurelayer_url=featurelayer_url, gis=gis),
+        layer_type=get_featurelayer_type(featurelayer_url=featurelayer_url, gis=gis),
+        name=name,
+        typed=typed,
+        physical_types=physical_types,
+        geolookups=geolookups
+    )
 
-    
+@timed_generator
+def get_featurelayer_bronzesqlview(
+    featurelayer_url : str,
+    gis : GIS,
+    name : str,
+    partition_columns : list = None,
+    typed : bool = False,
+    physical_types : dict = None,
+    geolookups : list = None
+) -> str:
+    return render_bronze_view_sql(
+        fields=get_featurelayer_fields(featurelayer_url=featurelayer_url, gis=gis),
+        layer_type=get_featurelayer_type(featurelayer_url=featurelayer_url, gis=gis),
+        name=name,
+        partition_columns=partition_columns,
+        typed=typed,
+        physical_types=physical_types,
+        geolookups=geolookups
+    )
+
+@timed_generator
 def get_featurelayer_silversqlfields(
     featurelayer_url : str,
-    gis : GIS
+    gis : GIS,
+    profiled : bool = False,
+    geolookups : list = None
 ) -> str:
-    fields = get_featurelayer_fields(featurelayer_url=featurelayer_url, gis=gis)
-    type_mappings = {
-        'esriFieldTypeString': lambda field: f"CAST([{field['name']}] AS VARCHAR({field['length'] if field['length'] < 8000 else 'MAX'})) AS [{clean_field_name(field['name'])}]",
-        'esriFieldTypeSmallInteger': lambda field: f"CAST(CAST([{field['name']}] AS FLOAT) AS INT) AS [{clean_field_name(field['name'])}]",
-        'esriFieldTypeBigInteger': lambda field: f"CAST(CAST([{field['name']}] AS FLOAT) AS BIGINT) AS [{clean_field_name(field['name'])}]",
-        'esriFieldTypeInteger': lambda field: f"CAST(CAST([{field['name']}] AS FLOAT) AS INT) AS [{clean_field_name(field['name'])}]",
-        'esriFieldTypeOID': lambda field: f"CAST([{field['name']}] AS INT) AS [{clean_field_name(field['name'])}]",
-        'esriFieldTypeGlobalID': lambda field: f"CAST([{field['name']}] AS CHAR(36)) AS [{clean_field_name(field['name'])}]",
-        'esriFieldTypeGUID': lambda field: f"CAST([{field['name']}] AS CHAR(36)) AS [{clean_field_name(field['name'])}]",
-        'esriFieldTypeDate': lambda field: f"""DATEADD(S, CAST([{field['name']}] AS FLOAT)/1000, '1970-01-01') AT TIME ZONE 'UTC' AT TIME ZONE 'Eastern Standard Time' AS [{clean_field_name(field['name'])}]""",
-        'esriFieldTypeDouble' : lambda field: f"CAST([{field['name']}] AS NUMERIC(38, 8)) AS [{clean_field_name(field['name'])}]",
-        'esriFieldTypeFloat' : lambda field: f"CAST([{field['name']}] AS NUMERIC(12, 6)) AS [{clean_field_name(field['name'])}]",
-        'esriFieldTypeSingle' : lambda field: f"CAST([{field['name']}] AS NUMERIC(12, 6)) AS [{clean_field_name(field['name'])}]",
-        'esriFieldTypeBlob': lambda field: f"CAST([{field['name']}] AS BINARY) AS [{clean_field_name(field['name'])}]"
-    }
-    sql = ''''''
-    for field in fields:
-        if field['name'] not in IGNORED_FIELDS and field['type'] != 'esriFieldTypeGeometry':
-            sql += '    ,' + type_mappings[field['type']](field) + '''
-'''
-    sql = '    ' + sql[5:-1] + '''
-    ,[INGEST_TS]
-    ,[INGEST_FILE]'''
+    # profiled sizes the VARCHAR and NUMERIC casts from the layer's data (get_featurelayer_profile) instead of the
+    # declared field lengths, which are often far longer than anything stored
+    return render_silver_fields(
+        fields=get_featurelayer_fields(featurelayer_url=featurelayer_url, gis=gis),
+        layer_type=get_featurelayer_type(featurelayer_url=featurelayer_url, gis=gis),
+        profile=get_featurelayer_profile(featurelayer_url, gis=gis) if profiled else None,
+        geolookups=geolookups
+    )
 
-    if get_featurelayer_type(featurelayer_url=featurelayer_url, gis=gis) == 'Feature Layer':
-        sql = sql + '''
-    ,[GEOMWKB]
-    ,[GEOMWKT]
-    ,ROUND([X], 8) AS [X]
-    ,ROUND([Y], 8) AS [Y]
-    ,ROUND([LONGITUDE], 8) AS [LONGITUDE]
-    ,ROUND([LATITUDE], 8) AS [LATITUDE]
-    ,ROUND([LENGTH], 4) AS [LENGTH]
-    ,ROUND([AREA], 4) AS [AREA]
-    ,CAST([GEOMTYPE] AS VARCHAR(30)) AS [GEOMTYPE]
-    ,CAST([COUNCIL2021] AS VARCHAR(1020)) AS [COUNCIL2021]
-    ,CAST([COUNCIL2021_DOMINANT] AS VARCHAR(255)) AS [COUNCIL2021_DOMINANT]
-    ,CAST([COUNCIL2021_AREAS] AS VARCHAR(MAX)) AS [COUNCIL2021_AREAS]
-    ,CAST([LEGISLATIVE2022] AS VARCHAR(1020)) AS [LEGISLATIVE2022]
-    ,CAST([LEGISLATIVE2022_DOMINANT] AS VARCHAR(255)) AS [LEGISLATIVE2022_DOMINANT]
-    ,CAST([LEGISLATIVE2022_AREAS] AS VARCHAR(MAX)) AS [LEGISLATIVE2022_AREAS]
-    ,CAST([CONGRESS2021] AS VARCHAR(1020)) AS [CONGRESS2021]
-    ,CAST([CONGRESS2021_DOMINANT] AS VARCHAR(255)) AS [CONGRESS2021_DOMINANT]
-    ,CAST([CONGRESS2021_AREAS] AS VARCHAR(MAX)) AS [CONGRESS2021_AREAS]
-    ,CAST([PARKPOLICEBEAT] AS VARCHAR(1020)) AS [PARKPOLICEBEAT]
-    ,CAST([PARKPOLICEBEAT_DOMINANT] AS VARCHAR(255)) AS [PARKPOLICEBEAT_DOMINANT]
-    ,CAST([PARKPOLICEBEAT_AREAS] AS VARCHAR(MAX)) AS [PARKPOLICEBEAT_AREAS]
-    ,CAST([REGIONALSERVICECENTER] AS VARCHAR(1020)) AS [REGIONALSERVICECENTER]
-    ,CAST([REGIONALSERVICECENTER_DOMINANT] AS VARCHAR(255)) AS [REGIONALSERVICECENTER_DOMINANT]
-    ,CAST([REGIONALSERVICECENTER_AREAS] AS VARCHAR(MAX)) AS [REGIONALSERVICECENTER_AREAS]
-    ,CAST([AGRESERVE] AS VARCHAR(1020)) AS [AGRESERVE]
-    ,CAST([AGRESERVE_DOMINANT] AS VARCHAR(255)) AS [AGRESERVE_DOMINANT]
-    ,CAST([AGRESERVE_AREAS] AS VARCHAR(MAX)) AS [AGRESERVE_AREAS]
-    ,CAST([CENSUSTRACT2020] AS VARCHAR(1020)) AS [CENSUSTRACT2020]
-    ,CAST([CENSUSTRACT2020_DOMINANT] AS VARCHAR(255)) AS [CENSUSTRACT2020_DOMINANT]
-    ,CAST([CENSUSTRACT2020_AREAS] AS VARCHAR(MAX)) AS [CENSUSTRACT2020_AREAS]
-    ,CAST([CENSUSTRACT2010] AS VARCHAR(1020)) AS [CENSUSTRACT2010]
-    ,CAST([CENSUSTRACT2010_DOMINANT] AS VARCHAR(255)) AS [CENSUSTRACT2010_DOMINANT]
-    ,CAST([CENSUSTRACT2010_AREAS] AS VARCHAR(MAX)) AS [CENSUSTRACT2010_AREAS]
-    ,CAST([GEOM_PARK_CODE] AS VARCHAR(150)) AS [GEOM_PARK_CODE]
-    ,CAST([GEOM_PARK_CODE_DOMINANT] AS VARCHAR(30)) AS [GEOM_PARK_CODE_DOMINANT]
-    ,CAST([GEOM_PARK_CODE_AREAS] AS VARCHAR(MAX)) AS [GEOM_PARK_CODE_AREAS]
-    ,CAST([GEOM_PARK_CODE_NEAREST] AS VARCHAR(30)) AS [GEOM_PARK_CODE_NEAREST]
-    ,ROUND([GEOM_PARK_CODE_NEARESTDISTANCE], 4) AS [GEOM_PARK_CODE_NEARESTDISTANCE]
-    ,CAST([GEOM_PARK_CODE_NEARESTAREAS] AS VARCHAR(MAX)) AS [GEOM_PARK_CODE_NEARESTAREAS]'''
-
-    return sql
+def render_latest_ingest_silver_table(
+    field_selection : str,
+    bronze_columns : str,
+    name : str,
+    sharded : bool = False
+) -> tuple:
+    # builds the silver cetas over only the newest ingest folder of the layer's bronze location instead of the bronze
+    # external table, so serverless sql reads one snapshot instead of every historical parquet file. the ingest
+    # folders follow BRONZE_PARTITION_COLUMNS, and the newest is the greatest path through all their levels. returns
+    # the folder lookup, which goes before the existing table is dropped so a layer without any ingest keeps its
+    # table, and the cetas, which runs as dynamic sql with the folder in its BULK path. the rows of the folder are
+    # also ranked by INGEST_TS in case an ingest was retried into the same folder, except when sharded, since every
+    # shard of the ingest stamps its own INGEST_TS and the folder alone is the ingest
+    name_lower = name.lower()
+    name_upper = name.upper()
+    create_table = f"""
+CREATE EXTERNAL TABLE [silver].[S_GIS_{name_upper}]
+    WITH (
+        LOCATION = 'silver/gis-{name_lower}',
+        DATA_SOURCE = mds_ldw_source,
+        FILE_FORMAT = raw_ion_parquet
+    ) AS
+SELECT
+{field_selection}
+FROM (
+    SELECT
+    *
+    ,ROW_NUMBER() OVER (PARTITION BY [OBJECTID] ORDER BY [INGEST_TS] DESC) AS [row_num]{'' if sharded else '''
+    ,RANK() OVER (ORDER BY [INGEST_TS] DESC) AS [ingest_num]'''}
+    FROM OPENROWSET(
+        BULK '/bronze/gis-bronze/{name}/<latest_ingest_folder>/**',
+        DATA_SOURCE = 'mds_ldw_source',
+        FORMAT = 'PARQUET'
+    ) WITH (
+{bronze_columns}
+    ) AS [r]
+)t1
+WHERE
+    [row_num] = 1{'' if sharded else '''
+    AND [ingest_num] = 1'''};"""
+    # quotes are doubled for the string literal. the folder is replaced into the MAX variable rather than concatenated
+    # between two literals, since a concatenation of literals under 4000 characters each is truncated to 4000
+    create_table = create_table.replace("'", "''")
+
+    find_folder = f"""    DECLARE @latest_ingest_folder NVARCHAR(400);
+    SELECT @latest_ingest_folder = MAX({render_ingest_folder_path()})
+    FROM OPENROWSET(
+        BULK '/bronze/gis-bronze/{name}/{render_ingest_folder_wildcards()}**',
+        DATA_SOURCE = 'mds_ldw_source',
+        FORMAT = 'PARQUET'
+    ) WITH ([INGEST_TS] VARCHAR(8000)) AS [r];
+    IF @latest_ingest_folder IS NULL
+        THROW 50000, 'No ingest folders found under /bronze/gis-bronze/{name}/', 1;
+    PRINT 'LATEST INGEST FOLDER: '+@latest_ingest_folder
+"""
+    create_table = f"""    DECLARE @create_sql NVARCHAR(MAX) = N'{create_table}';
+    SET @create_sql = REPLACE(@create_sql, N'<latest_ingest_folder>', REPLACE(@latest_ingest_folder, CHAR(39), CHAR(39) + CHAR(39)));
+    EXECUTE sp_executesql @create_sql"""
+    return find_folder, create_table
+
+def render_incremental_silver_table(
+    field_selection : str,
+    edit_tracking : dict,
+    name : str
+) -> str:
+    # with incremental stage parameters each ingest only holds the features edited since the previous one, so instead
+    # of keeping just the newest ingest, the newest version of every feature is taken across the whole bronze history.
+    # deleted features never show up in a delta and stay in silver until the bronze history is reset by a full pull
+    name_lower = name.lower()
+    name_upper = name.upper()
+    return f"""CREATE EXTERNAL TABLE [silver].[S_GIS_{name_upper}]
+    WITH (
+        LOCATION = 'silver/gis-{name_lower}',
+        DATA_SOURCE = mds_ldw_source,
+        FILE_FORMAT = raw_ion_parquet
+    ) AS
+SELECT
+{field_selection}
+FROM (
+    SELECT
+    *
+    ,ROW_NUMBER() OVER (PARTITION BY [{edit_tracking['key_field']}] ORDER BY CAST([{edit_tracking['edit_date_field']}] AS FLOAT) DESC, [INGEST_TS] DESC) AS [row_num]
+    FROM [bronze].[B_GIS_{name_upper}]
+)t1
+WHERE
+    [row_num] = 1;"""
 
+@timed_generator
 def get_featurelayer_silversqlprocedure(
     featurelayer_url : str,
     gis : GIS,
-    name : str
+    name : str,
+    latest_ingest_only : bool = False,
+    typed_bronze : bool = False,
+    profiled : bool = False,
+    incremental : bool = False,
+    geolookups : list = None,
+    sharded : bool = False,
+    physical_types : dict = None
 ) -> str:
+    # with latest_ingest_only the procedure reads only the newest ingest folder of the bronze location, see
+    # render_latest_ingest_silver_table. otherwise it scans the full bronze history through the external table.
+    # typed_bronze, physical_types and geolookups should match how the bronze ddl was generated, they set the columns of
+    # the OPENROWSET read.
+    # incremental merges the deltas of incremental stage parameters, see render_incremental_silver_table.
+    # sharded should match the stage parameters. the shards of an ingest each stamp their own INGEST_TS, so sharded
+    # silver always reads the newest ingest folder, as with latest_ingest_only, which holds every shard of the run
+    if incremental and latest_ingest_only:
+        raise ValueError('incremental silver procedures merge every ingest, so they cannot read only the latest one')
     name_lower = name.lower()
     name_upper = name.upper()
 
-    field_selection = get_featurelayer_silversqlfields(featurelayer_url=featurelayer_url, gis=gis)
+    field_selection = get_featurelayer_silversqlfields(featurelayer_url=featurelayer_url, gis=gis, profiled=profiled, geolookups=geolookups)
+    # runs ahead of dropping the existing table
+    before_drop = ''
+    edit_tracking = get_featurelayer_edit_tracking(featurelayer_url, gis=gis) if incremental else None
+    if edit_tracking is not None:
+        create_table = render_incremental_silver_table(field_selection, edit_tracking, name)
+    elif latest_ingest_only or sharded:
+        bronze_columns = render_bronze_columns(
+            fields=get_featurelayer_fields(featurelayer_url=featurelayer_url, gis=gis),
+            layer_type=get_featurelayer_type(featurelayer_url=featurelayer_url, gis=gis),
+            typed=typed_bronze,
+            physical_types=physical_types,
+            geolookups=geolookups
+        )
+        before_drop, create_table = render_latest_ingest_silver_table(field_selection, '    ' + bronze_columns.replace('\n    ', '\n        '), name, sharded=sharded)
+        before_drop += '\n'
+    else:
+        create_table = f"""CREATE EXTERNAL TABLE [silver].[S_GIS_{name_upper}]
+    WITH (
+        LOCATION = 'silver/gis-{name_lower}',
+        DATA_SOURCE = mds_ldw_source,
+        FILE_FORMAT = raw_ion_parquet
+    ) AS
+SELECT
+{field_selection}
+FROM (
+    SELECT
+    *
+    ,ROW_NUMBER() OVER (PARTITION BY [OBJECTID] ORDER BY [INGEST_TS] DESC) AS [row_num]
+    ,RANK() OVER (ORDER BY [INGEST_TS] DESC) AS [ingest_num]
+    FROM [bronze].[B_GIS_{name_upper}]
+)t1
+WHERE
+    [row_num] = 1
+    AND [ingest_num] = 1;"""
+
     procedure = f"""
 USE mds_ldw;
 GO
@@ -297,28 +1895,11 @@ BEGIN
     DECLARE @external_data_source sysname='mds_ldw_source';
     DECLARE @external_file_format sysname='raw_ion_parquet';
 
-    PRINT @drop_existing_sql
+{before_drop}    PRINT @drop_existing_sql
     EXECUTE sp_executesql @drop_existing_sql
     PRINT 'DROPPED EXTERNAL TABLE: '+@external_tbl_name
 
-CREATE EXTERNAL TABLE [silver].[S_GIS_{name_upper}]
-    WITH (
-        LOCATION = 'silver/gis-{name_lower}',
-        DATA_SOURCE = mds_ldw_source,
-        FILE_FORMAT = raw_ion_parquet
-    ) AS
-SELECT
-{field_selection}
-FROM (
-    SELECT
-    *
-    ,ROW_NUMBER() OVER (PARTITION BY [OBJECTID] ORDER BY [INGEST_TS] DESC) AS [row_num]
-    ,RANK() OVER (ORDER BY [INGEST_TS] DESC) AS [ingest_num]
-    FROM [bronze].[B_GIS_{name_upper}]
-)t1
-WHERE
-    [row_num] = 1
-    AND [ingest_num] = 1;
+{create_table}
 END;
 
 /*
@@ -347,21 +1928,9 @@ def get_prefixed_field_aliases(
 def print_geolookup_fields(
     fields: list[str]
 ) -> str:
-    bronze = ''
-    for field in fields:
-        bronze += f"""
-{field} VARCHAR(8000),
-{field}_DOMINANT VARCHAR(8000),
-{field}_AREAS VARCHAR(8000),"""
-    bronze = bronze[:-1]
-
-    silver = ''
-    for field in fields:
-        silver += f"""
-CAST([{field}] AS VARCHAR(1020)) AS [{field}],
-CAST({field}_DOMINANT AS VARCHAR(255)) AS {field}_DOMINANT,
-CAST({field}_AREAS AS VARCHAR(MAX)) AS {field}_AREAS,"""
-    silver = silver[:-1]
+    # renders the columns of the given lookups the way the ddl does, including lookups that are not in GEOLOOKUPS yet
+    bronze = render_geolookup_columns(tuple(fields), 'bronze')
+    silver = render_geolookup_columns(tuple(fields), 'silver')
     print(bronze)
     print("""
 
@@ -370,71 +1939,953 @@ CAST({field}_AREAS AS VARCHAR(MAX)) AS {field}_AREAS,"""
 """)
     print(silver)
 
+# In[51]:
+
+# each layer's schema (field names, types and lengths plus the layer type) is fingerprinted and recorded from run to
+# run, so a regeneration only emits scripts for the layers that changed, led by a column level diff
+SCHEMA_STATE_PATH = os.environ.get(
+    'FEATURESERVICE_HELPER_STATE_PATH',
+    os.path.join(os.path.expanduser('~'), '.featureservice_azure_helper', 'schema_state.json')
+)
+
+
+def get_featurelayer_schema(
+    featurelayer_url : str,
+    gis : GIS
+) -> dict:
+    # only what the generated ddl depends on
+    return {
+        'type': get_featurelayer_type(featurelayer_url=featurelayer_url, gis=gis),
+        'fields': [
+            [field['name'], field['type'], field.get('length')]
+            for field in get_featurelayer_fields(featurelayer_url=featurelayer_url, gis=gis)
+            if field['name'] not in IGNORED_FIELDS
+        ]
+    }
+
+def get_schema_fingerprint(
+    schema : dict
+) -> str:
+    return hashlib.sha1(json.dumps(schema, sort_keys=True).encode('utf-8')).hexdigest()
+
+def load_schema_state(
+    state_path : str = None
+) -> dict:
+    try:
+        with open(state_path or SCHEMA_STATE_PATH, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_schema_state(
+    state : dict,
+    state_path : str = None
+) -> None:
+    state_path = state_path or SCHEMA_STATE_PATH
+    os.makedirs(os.path.dirname(os.path.abspath(state_path)), exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=os.path.dirname(os.path.abspath(state_path)), suffix='.tmp', delete=False) as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(f.name, state_path)
+
+def diff_featurelayer_schema(
+    old_schema : dict,
+    new_schema : dict
+) -> dict:
+    old_fields = {name: (field_type, length) for name, field_type, length in old_schema['fields']}
+    new_fields = {name: (field_type, length) for name, field_type, length in new_schema['fields']}
+    return {
+        'type': (old_schema['type'], new_schema['type']) if old_schema['type'] != new_schema['type'] else None,
+        'added': [[name, *new_fields[name]] for name in new_fields if name not in old_fields],
+        'removed': [[name, *old_fields[name]] for name in old_fields if name not in new_fields],
+        'retyped': [[name, *old_fields[name], *new_fields[name]] for name in new_fields if name in old_fields and old_fields[name] != new_fields[name]]
+    }
+
+def render_schema_diff(
+    name : str,
+    diff : dict
+) -> str:
+    # serverless external tables cannot be altered in place, so the diff is written as alter style comments ahead of
+    # the regenerated scripts to show what the redeploy changes
+    if diff is None:
+        return f'-- {name}: new layer\n'
+
+    lines = [f'-- {name}: schema changed']
+    if diff['type']:
+        lines.append(f"--     layer type {diff['type'][0]} -> {diff['type'][1]}")
+    for field_name, field_type, length in diff['added']:
+        lines.append(f'--     ADD COLUMN [{field_name}] {field_type}' + (f'({length})' if length else ''))
+    for field_name, field_type, length in diff['removed']:
+        lines.append(f'--     DROP COLUMN [{field_name}] {field_type}' + (f'({length})' if length else ''))
+    for field_name, old_type, old_length, new_type, new_length in diff['retyped']:
+        lines.append(
+            f'--     ALTER COLUMN [{field_name}] {old_type}' + (f'({old_length})' if old_length else '')
+            + f' -> {new_type}' + (f'({new_length})' if new_length else '')
+        )
+    return '\n'.join(lines) + '\n'
+
+def get_changed_featurelayers(
+    layers : list,
+    gis : GIS,
+    state : dict
+) -> list:
+    # returns (name, url, schema, diff) for each layer whose fingerprint differs from the recorded one. diff is None
+    # for layers that have not been recorded before
+    prefetch_featurelayer_properties([layer[1] for layer in layers], gis=gis)
+    changed = []
+    for name, url, *_ in layers:
+        schema = get_featurelayer_schema(url, gis=gis)
+        recorded = state.get(name)
+        if recorded is not None and recorded['fingerprint'] == get_schema_fingerprint(schema):
+            continue
+        changed.append((name, url, schema, diff_featurelayer_schema(recorded['schema'], schema) if recorded else None))
+    return changed
+
+def regenerate_changed_featurelayers(
+    layers : list,
+    gis : GIS,
+    state_path : str = None,
+    record : bool = True
+) -> list:
+    # returns (name, sql) for every changed layer, where sql is the diff followed by the stage parameters, bronze ddl
+    # and silver procedure. with record the new fingerprints are saved once everything rendered
+    state = load_schema_state(state_path)
+    item_ids = {layer[0]: layer[2] if len(layer) > 2 else None for layer in layers}
+    regenerated = []
+    changed = get_changed_featurelayers(layers, gis=gis, state=state)
+    prefetch_item_owners([item_ids[name] for name, *_ in changed], gis=gis)
+    for name, url, schema, diff in changed:
+        sql = '\n'.join([
+            render_schema_diff(name, diff),
+            get_featurelayer_stage_parameters(url, gis=gis, name=name, item_id=item_ids[name]),
+            get_featurelayer_bronzesqlfields(url, gis=gis, name=name, geolookups=LAYER_GEOLOOKUPS.get(name)),
+            get_featurelayer_silversqlprocedure(url, gis=gis, name=name, geolookups=LAYER_GEOLOOKUPS.get(name))
+        ])
+        regenerated.append((name, sql))
+        state[name] = {'url': url, 'fingerprint': get_schema_fingerprint(schema), 'schema': schema}
+
+    if record and regenerated:
+        save_schema_state(state, state_path)
+    return regenerated
+
+# In[52]:
+
+# each layer's parquet schema can be written ahead of time as a json artifact, so the ingest loads it instead of
+# inferring one from the geojson (see arrow_schema in get_featurelayer_stage_parameters). the types are read off the
+# typed bronze columns, so the artifact, the parquet files and the typed bronze ddl always agree. this covers every
+# type the generator emits and the usual physical_types overrides, a type without an arrow equivalent raises rather
+# than being written as a string column. DECIMAL and NUMERIC map to decimal128 with their precision and scale, and
+# FLOAT(1) to FLOAT(24) to float, see get_arrow_type
+SQL_ARROW_TYPES = {
+    'VARCHAR': 'string',
+    'NVARCHAR': 'string',
+    'CHAR': 'string',
+    'NCHAR': 'string',
+    'UNIQUEIDENTIFIER': 'string',
+    'VARBINARY': 'binary',
+    'BINARY': 'binary',
+    'BIGINT': 'int64',
+    'INT': 'int32',
+    'SMALLINT': 'int16',
+    'TINYINT': 'uint8',
+    'BIT': 'bool',
+    'FLOAT': 'double',
+    'REAL': 'float',
+    'DATE': 'date32',
+    'DATETIME': 'timestamp[us]',
+    'DATETIME2': 'timestamp[us]',
+    'TIME': 'time64[us]',
+}
+# where the artifacts are uploaded, relative to the ingest function's storage, and what the stage parameters point to
+ARROW_SCHEMA_LOCATION = 'gis-schema/{name}.schema.json'
+
+
+def get_arrow_type(
+    column_name : str,
+    sql_type : str,
+    arguments : str = None
+) -> str:
+    # the arrow type name of a declared sql type, arguments being what is inside its parentheses if anything
+    sql_type = sql_type.upper()
+    if sql_type in ('DECIMAL', 'NUMERIC'):
+        precision, scale = ([int(argument) for argument in arguments.split(',')] + [0])[:2] if arguments else (18, 0)
+        return f'decimal128({precision}, {scale})'
+    if sql_type == 'FLOAT' and arguments and int(arguments) <= 24:
+        return 'float'
+    if sql_type not in SQL_ARROW_TYPES:
+        raise ValueError(f"No arrow type for column '{column_name}' declared as {sql_type}, add it to SQL_ARROW_TYPES first")
+    return SQL_ARROW_TYPES[sql_type]
+
+def get_arrow_column_types(
+    bronze_columns : str
+) -> list:
+    # (column name, arrow type) for each column definition rendered by render_bronze_columns
+    return [
+        (column_name, get_arrow_type(column_name, sql_type, arguments))
+        for column_name, sql_type, arguments in re.findall(r'^\s*,?\[(.+)\] (\w+)(?:\s*\(([^)]*)\))?', bronze_columns, flags=re.MULTILINE)
+    ]
+
+@timed_generator
+def get_featurelayer_arrow_schema(
+    featurelayer_url : str,
+    gis : GIS,
+    name : str,
+    geolookups : list = None,
+    physical_types : dict = None
+) -> dict:
+    # every column the transform writes, in bronze order, with its arrow type name (see to_arrow_type). the
+    # fingerprint is the layer's schema fingerprint, so a stale artifact can be detected
+    columns = render_bronze_columns(
+        fields=get_featurelayer_fields(featurelayer_url=featurelayer_url, gis=gis),
+        layer_type=get_featurelayer_type(featurelayer_url=featurelayer_url, gis=gis),
+        typed=True,
+        physical_types=physical_types,
+        geolookups=geolookups
+    )
+    return {
+        'name': name,
+        'url': featurelayer_url,
+        'fingerprint': get_schema_fingerprint(get_featurelayer_schema(featurelayer_url, gis=gis)),
+        'fields': [{'name': column_name, 'type': arrow_type} for column_name, arrow_type in get_arrow_column_types(columns)]
+    }
+
+def write_featurelayer_arrow_schema(
+    featurelayer_url : str,
+    gis : GIS,
+    name : str,
+    output_dir : str,
+    geolookups : list = None,
+    physical_types : dict = None
+) -> str:
+    # writes the artifact as <output_dir>/<name>.schema.json, to be uploaded to ARROW_SCHEMA_LOCATION
+    schema = get_featurelayer_arrow_schema(featurelayer_url, gis=gis, name=name, geolookups=geolookups, physical_types=physical_types)
+    path = os.path.join(output_dir, os.path.basename(ARROW_SCHEMA_LOCATION.format(name=name)))
+    os.makedirs(output_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=output_dir, suffix='.tmp', delete=False) as f:
+        json.dump(schema, f, indent=2)
+    os.replace(f.name, path)
+    return path
+
+def to_arrow_type(
+    type_name : str
+):
+    # pyarrow.type_for_alias accepts every arrow type name of SQL_ARROW_TYPES, decimals are built from their precision
+    # and scale
+    import pyarrow
+    decimal = re.fullmatch(r'decimal128\((\d+), (\d+)\)', type_name)
+    if decimal:
+        return pyarrow.decimal128(int(decimal.group(1)), int(decimal.group(2)))
+    return pyarrow.type_for_alias(type_name)
+
+def to_arrow_schema(
+    schema : dict
+):
+    # builds the pyarrow.Schema of an artifact, which is what the ingest side does with it. pyarrow is only needed here
+    import pyarrow
+    return pyarrow.schema([
+        pyarrow.field(field['name'], to_arrow_type(field['type']), nullable=True)
+        for field in schema['fields']
+    ], metadata={'fingerprint': schema['fingerprint']})
+
+# In[53]:
+
+# checks local copies of the bronze parquet files against the columns the bronze ddl declares. only the footers are
+# read, memory mapped, so thousands of ingest files take seconds. a missing column reads as NULL in serverless, an
+# extra one is silently dropped and a mismatched type fails the query
+
+# the parquet types each declared arrow type reads without conversion
+ARROW_COMPATIBLE_TYPES = {
+    'string': {'string', 'large_string'},
+    'binary': {'binary', 'large_binary'},
+    'bool': {'bool'},
+    'uint8': {'uint8'},
+    'int16': {'int8', 'uint8', 'int16'},
+    'int32': {'int8', 'uint8', 'int16', 'uint16', 'int32'},
+    'int64': {'int8', 'uint8', 'int16', 'uint16', 'int32', 'uint32', 'int64'},
+    'float': {'float'},
+    'double': {'float', 'double'},
+    'date32': {'date32[day]'},
+    'timestamp[us]': {'timestamp[ms]', 'timestamp[us]', 'timestamp[ns]'},
+    'time64[us]': {'time32[ms]', 'time64[us]', 'time64[ns]'},
+}
+
+
+def read_parquet_schema(
+    path : str
+) -> dict:
+    # {column name: arrow type} from the file's footer. pyarrow is only needed for the conformance checks
+    import pyarrow.parquet
+    return {field.name: str(field.type) for field in pyarrow.parquet.read_schema(path, memory_map=True)}
+
+def find_parquet_files(
+    directory : str
+) -> list:
+    return sorted(
+        os.path.join(root, file_name)
+        for root, _, file_names in os.walk(directory)
+        for file_name in file_names if file_name.endswith('.parquet')
+    )
+
+def compare_parquet_schema(
+    expected : dict,
+    actual : dict
+) -> dict:
+    # a VARCHAR column reads any parquet type, which covers every attribute column of untyped bronze and the nullable
+    # integer and date fields of typed bronze, so only the columns with another declared type are type checked
+    return {
+        'missing': [column for column in expected if column not in actual],
+        'extra': [column for column in actual if column not in expected],
+        'mismatched': [
+            [column, expected_type, actual[column]] for column, expected_type in expected.items()
+            if column in actual and expected_type != 'string'
+            and actual[column] not in ARROW_COMPATIBLE_TYPES.get(expected_type, {expected_type})
+        ]
+    }
+
+def check_featurelayer_parquet_conformance(
+    featurelayer_url : str,
+    gis : GIS,
+    name : str,
+    bronze_dir : str,
+    typed : bool = False,
+    geolookups : list = None,
+    physical_types : dict = None,
+    max_workers : int = 8
+) -> dict:
+    # compares every parquet file under <bronze_dir>/<name> with the bronze ddl generated with the same options.
+    # files with the same schema are compared once, and only schemas that do not conform are reported
+    expected = dict(get_arrow_column_types(render_bronze_columns(
+        fields=get_featurelayer_fields(featurelayer_url=featurelayer_url, gis=gis),
+        layer_type=get_featurelayer_type(featurelayer_url=featurelayer_url, gis=gis),
+        typed=typed,
+        physical_types=physical_types,
+        geolookups=geolookups
+    )))
+    paths = find_parquet_files(os.path.join(bronze_dir, name))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        schemas = list(executor.map(read_parquet_schema, paths))
+
+    files_by_schema = defaultdict(list)
+    for path, schema in zip(paths, schemas):
+        files_by_schema[tuple(schema.items())].append(path)
+
+    nonconforming = []
+    for schema, files in files_by_schema.items():
+        comparison = compare_parquet_schema(expected, dict(schema))
+        if comparison['missing'] or comparison['extra'] or comparison['mismatched']:
+            nonconforming.append({'files': files, **comparison})
+    return {'name': name, 'file_count': len(paths), 'nonconforming': nonconforming}
+
+def check_featurelayers_parquet_conformance(
+    layers : list,
+    gis : GIS,
+    bronze_dir : str,
+    typed : bool = False
+) -> list:
+    prefetch_featurelayer_properties([layer[1] for layer in layers], gis=gis)
+    return [
+        check_featurelayer_parquet_conformance(url, gis=gis, name=name, bronze_dir=bronze_dir, typed=typed, geolookups=LAYER_GEOLOOKUPS.get(name))
+        for name, url, *_ in layers
+    ]
+
+def render_conformance_report(
+    reports : list
+) -> str:
+    lines = []
+    for report in reports:
+        if not report['file_count']:
+            lines.append(f"{report['name']}: no parquet files found")
+            continue
+        if not report['nonconforming']:
+            lines.append(f"{report['name']}: {report['file_count']} files conform")
+            continue
+        lines.append(f"{report['name']}: {sum(len(schema['files']) for schema in report['nonconforming'])} of {report['file_count']} files do not conform")
+        for schema in report['nonconforming']:
+            lines.append(f"    {len(schema['files'])} files, e.g. {schema['files'][0]}")
+            for column in schema['missing']:
+                lines.append(f'        missing    [{column}]')
+            for column in schema['extra']:
+                lines.append(f'        extra      [{column}]')
+            for column, expected_type, actual_type in schema['mismatched']:
+                lines.append(f'        mismatched [{column}] declared {expected_type}, parquet {actual_type}')
+    return '\n'.join(lines)
+
+# In[54]:
+
+# a sqlite catalog of every layer's schema, for questions across layers (which layers have PARK_CODE, where is SIZE_
+# still used) without requesting the services again. it is built from the same properties the generators use and,
+# being a MetadataBackend, can be passed as gis to render the ddl from the catalog alone
+SCHEMA_CATALOG_PATH = os.environ.get(
+    'FEATURESERVICE_HELPER_CATALOG_PATH',
+    os.path.join(os.path.expanduser('~'), '.featureservice_azure_helper', 'schema_catalog.sqlite')
+)
+
+SCHEMA_CATALOG_DDL = '''
+CREATE TABLE IF NOT EXISTS layers (
+    name TEXT PRIMARY KEY,
+    url TEXT NOT NULL UNIQUE,
+    item_id TEXT,
+    layer_type TEXT,
+    geometry_type TEXT,
+    portal_url TEXT,
+    fingerprint TEXT,
+    properties TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS fields (
+    layer_name TEXT NOT NULL REFERENCES layers (name) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    clean_name TEXT NOT NULL,
+    type TEXT NOT NULL,
+    length INTEGER,
+    alias TEXT,
+    nullable INTEGER,
+    PRIMARY KEY (layer_name, name)
+);
+CREATE INDEX IF NOT EXISTS fields_name ON fields (name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS fields_clean_name ON fields (clean_name);
+'''
+
+
+class SchemaCatalog(MetadataBackend):
+    # fields are matched on their name (case insensitive) or their clean_field_name, so SIZE_ also finds SIZE
+    def __init__(self, path : str = None):
+        self.path = path or SCHEMA_CATALOG_PATH
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute('PRAGMA foreign_keys = ON')
+        self._connection.executescript(SCHEMA_CATALOG_DDL)
+        self._lock = threading.Lock()
+
+    def query(self, sql : str, params : tuple = ()) -> list:
+        with self._lock:
+            return self._connection.execute(sql, params).fetchall()
+
+    def add_layers(self, layers : list, gis : GIS) -> None:
+        # adds or replaces the given (name, url, item id) layers in one transaction, fetching what is not cached
+        prefetch_featurelayer_properties([layer[1] for layer in layers], gis=gis)
+        rows = []
+        for layer in layers:
+            name, url = layer[0], layer[1]
+            properties = get_featurelayer_properties(url, gis=gis)
+            rows.append((name, url, layer[2] if len(layer) > 2 else None, properties, get_portal_url(url, gis=gis),
+                         get_schema_fingerprint(get_featurelayer_schema(url, gis=gis))))
+
+        with self._lock, self._connection:
+            for name, url, item_id, properties, portal_url, fingerprint in rows:
+                self._connection.execute('DELETE FROM layers WHERE name = ? OR url = ?', (name, url))
+                self._connection.execute(
+                    'INSERT INTO layers VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (name, url, item_id, properties.get('type'), properties.get('geometryType'), portal_url, fingerprint,
+                     json.dumps(properties), time.time())
+                )
+                self._connection.executemany('INSERT INTO fields VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [
+                    (name, position, field['name'], clean_field_name(field['name']), field['type'], field.get('length'),
+                     field.get('alias'), None if field.get('nullable') is None else int(field['nullable']))
+                    for position, field in enumerate(properties.get('fields') or [])
+                ])
+
+    def layer_names(self) -> list:
+        return [row[0] for row in self.query('SELECT name FROM layers ORDER BY name')]
+
+    def get_layer_url(self, name : str) -> str:
+        rows = self.query('SELECT url FROM layers WHERE name = ?', (name,))
+        return rows[0][0] if rows else None
+
+    def get_layer_fields(self, name : str) -> list:
+        # the layer's fields in service order, like get_featurelayer_fields
+        return [
+            {'name': field_name, 'type': field_type, 'alias': alias, 'length': length, 'nullable': None if nullable is None else bool(nullable)}
+            for field_name, field_type, alias, length, nullable in self.query(
+                'SELECT name, type, alias, length, nullable FROM fields WHERE layer_name = ? ORDER BY position', (name,)
+            )
+        ]
+
+    def layers_with_field(self, field_name : str) -> list:
+        return [row[0] for row in self.query(
+            'SELECT DISTINCT layer_name FROM fields WHERE name = ? COLLATE NOCASE OR clean_name = ? ORDER BY layer_name',
+            (field_name, clean_field_name(field_name))
+        )]
+
+    def field_usage(self, field_name : str) -> list:
+        # (layer, field name, type, length) for every layer with the field, to spot inconsistent types and lengths
+        return self.query(
+            'SELECT layer_name, name, type, length FROM fields WHERE name = ? COLLATE NOCASE OR clean_name = ? ORDER BY layer_name',
+            (field_name, clean_field_name(field_name))
+        )
+
+    def layers_sharing_fields(self, field_names : list, min_shared : int = 1) -> list:
+        # (layer, [shared clean names]) for every layer with at least min_shared of the fields, most shared first
+        clean_names = sorted({clean_field_name(field_name) for field_name in field_names})
+        if not clean_names:
+            return []
+        rows = self.query(
+            f"SELECT layer_name, clean_name FROM fields WHERE clean_name IN ({', '.join('?' for _ in clean_names)}) ORDER BY layer_name, position",
+            tuple(clean_names)
+        )
+        shared = defaultdict(list)
+        for layer_name, clean_name in rows:
+            shared[layer_name].append(clean_name)
+        return sorted(
+            ((layer_name, names) for layer_name, names in shared.items() if len(names) >= min_shared),
+            key=lambda layer: (-len(layer[1]), layer[0])
+        )
+
+    @property
+    def url(self) -> str:
+        rows = self.query('SELECT portal_url FROM layers WHERE portal_url IS NOT NULL LIMIT 1')
+        return rows[0][0] if rows else None
+
+    def get_json(self, url : str, params : dict = None) -> dict:
+        # answers the requests the generators make: a layer, a service's /layers, and a service root, which has no
+        # editingInfo here so cached entries are simply refreshed from the catalog
+        url = url.rstrip('/')
+        rows = self.query('SELECT properties FROM layers WHERE url = ?', (url,))
+        if rows:
+            return json.loads(rows[0][0])
+        service_url = url[:-len('/layers')] if url.endswith('/layers') else url
+        rows = self.query("SELECT layer_type, properties FROM layers WHERE substr(url, 1, ?) = ?", (len(service_url) + 1, service_url + '/'))
+        if not rows:
+            raise ArcGISRestError(url, 404, 'Not in the schema catalog')
+        if not url.endswith('/layers'):
+            return {}
+        return {
+            'layers': [json.loads(properties) for layer_type, properties in rows if layer_type != 'Table'],
+            'tables': [json.loads(properties) for layer_type, properties in rows if layer_type == 'Table']
+        }
+
+# In[55]:
+
+# batch generation from a layer manifest, a json list of {"name", "url", "item_id", "options"} (or {"layers": [...]})
+# entries. each layer's stage parameters, bronze ddl and silver procedure are written to <name>.sql as soon as they
+# are rendered and appended to deploy.sql, so only one layer's sql is held at a time and a failed layer or an
+# interrupted run keeps everything finished before it. manifest.json records what was written for every layer
+BATCH_DEPLOY_FILE = 'deploy.sql'
+BATCH_MANIFEST_FILE = 'manifest.json'
+# the per layer options a manifest entry can set, and the generator keyword each one is passed as
+LAYER_MANIFEST_OPTIONS = {
+    'geolookups': {'bronze': 'geolookups', 'silver': 'geolookups', 'arrow_schema': 'geolookups'},
+    'typed_bronze': {'bronze': 'typed', 'silver': 'typed_bronze'},
+    'physical_types': {'bronze': 'physical_types', 'silver': 'physical_types', 'arrow_schema': 'physical_types'},
+    'profiled': {'silver': 'profiled'},
+    'latest_ingest_only': {'silver': 'latest_ingest_only'},
+    'incremental': {'stage': 'incremental', 'silver': 'incremental'},
+    'sharded': {'stage': 'sharded', 'silver': 'sharded'},
+    'records_per_shard': {'stage': 'records_per_shard'},
+    'arrow_schema': {'stage': 'arrow_schema'},
+}
+# the subcommands handled by main. a command line naming one of them runs main, anything else the notebook driver below
+CLI_COMMANDS = ('generate', 'watch')
+
+
+def load_layer_manifest(
+    manifest_path : str
+) -> list:
+    with open(manifest_path, encoding='utf-8') as f:
+        manifest = json.load(f)
+    entries = manifest['layers'] if isinstance(manifest, dict) else manifest
+
+    layers = []
+    for i, entry in enumerate(entries):
+        if not entry.get('name') or not entry.get('url'):
+            raise ValueError(f"Layer {i} of '{manifest_path}' needs a name and a url")
+        unknown = set(entry.get('options') or {}) - set(LAYER_MANIFEST_OPTIONS)
+        if unknown:
+            raise ValueError(f"Unknown options for layer '{entry['name']}': {', '.join(sorted(unknown))}")
+        layers.append({
+            'name': entry['name'],
+            'url': entry['url'],
+            'item_id': entry.get('item_id'),
+            'options': dict(entry.get('options') or {})
+        })
+    return layers
+
+def get_generator_options(
+    options : dict,
+    generator : str
+) -> dict:
+    # the keywords of generator ('stage', 'bronze', 'silver' or 'arrow_schema') set by a manifest entry's options
+    return {
+        LAYER_MANIFEST_OPTIONS[option][generator]: value
+        for option, value in options.items()
+        if generator in LAYER_MANIFEST_OPTIONS[option]
+    }
+
+def render_featurelayer_batch_sql(
+    layer : dict,
+    gis : GIS
+) -> str:
+    name, url, options = layer['name'], layer['url'], layer['options']
+    return '\n'.join([
+        f'-- {name}\n-- {url}\n',
+        get_featurelayer_stage_parameters(url, gis=gis, name=name, item_id=layer['item_id'], **get_generator_options(options, 'stage')),
+        get_featurelayer_bronzesqlfields(url, gis=gis, name=name, **get_generator_options(options, 'bronze')),
+        get_featurelayer_silversqlprocedure(url, gis=gis, name=name, **get_generator_options(options, 'silver'))
+    ])
+
+def write_batch_file(
+    output_dir : str,
+    file_name : str,
+    content : str
+) -> str:
+    path = os.path.join(output_dir, file_name)
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=output_dir, suffix='.tmp', delete=False) as f:
+        f.write(content)
+    os.replace(f.name, path)
+    return path
+
+def generate_featurelayer_batch(
+    layers : list,
+    gis : GIS,
+    output_dir : str
+) -> list:
+    # renders the manifest's layers in order into output_dir and returns the manifest entries, one per layer with
+    # 'status' 'ok' or 'failed'. a layer that fails is reported and skipped rather than ending the run
+    os.makedirs(output_dir, exist_ok=True)
+    # all metadata is fetched up front in parallel, rendering then runs from the cache. a layer that could not be
+    # fetched is tried again, and reported, when its turn comes
+    prefetch_featurelayer_properties([layer['url'] for layer in layers], gis=gis, skip_failed=True)
+    prefetch_item_owners([layer['item_id'] for layer in layers], gis=gis)
+
+    entries = []
+    deploy_path = os.path.join(output_dir, BATCH_DEPLOY_FILE)
+    try:
+        with open(deploy_path + '.tmp', 'w', encoding='utf-8') as deploy:
+            for layer in layers:
+                entry = {'name': layer['name'], 'url': layer['url'], 'item_id': layer['item_id'], 'options': layer['options']}
+                started_at = time.perf_counter()
+                try:
+                    sql = render_featurelayer_batch_sql(layer, gis=gis)
+                    entry['files'] = [os.path.basename(write_batch_file(output_dir, f"{layer['name']}.sql", sql))]
+                    if layer['options'].get('arrow_schema'):
+                        entry['files'].append(os.path.basename(write_featurelayer_arrow_schema(
+                            layer['url'], gis=gis, name=layer['name'], output_dir=output_dir,
+                            **get_generator_options(layer['options'], 'arrow_schema')
+                        )))
+                    entry['fingerprint'] = get_schema_fingerprint(get_featurelayer_schema(layer['url'], gis=gis))
+                    entry['sha1'] = hashlib.sha1(sql.encode('utf-8')).hexdigest()
+                    entry['status'] = 'ok'
+                    deploy.write(sql + '\n')
+                    deploy.flush()
+                except Exception as e:
+                    print(f"WARNING: Could not generate '{layer['name']}': {e!r}")
+                    entry['status'] = 'failed'
+                    entry['error'] = repr(e)
+                entry['seconds'] = round(time.perf_counter() - started_at, 3)
+                entries.append(entry)
+    finally:
+        # whatever finished is kept, including when the run itself is interrupted
+        if os.path.exists(deploy_path + '.tmp'):
+            os.replace(deploy_path + '.tmp', deploy_path)
+        write_batch_file(output_dir, BATCH_MANIFEST_FILE, json.dumps({
+            'generated_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'deploy': BATCH_DEPLOY_FILE,
+            'layers': entries
+        }, indent=2))
+    return entries
+
+def regenerate_featurelayer_batch(
+    layers : list,
+    gis : GIS,
+    output_dir : str,
+    state_path : str = None
+) -> list:
+    # like regenerate_changed_featurelayers for manifest layers: rewrites <name>.sql, led by the schema diff, for
+    # every layer whose fingerprint differs from the recorded one and records the new fingerprints. returns the names
+    state = load_schema_state(state_path)
+    changed = get_changed_featurelayers([(layer['name'], layer['url']) for layer in layers], gis=gis, state=state)
+    layers = {layer['name']: layer for layer in layers}
+    os.makedirs(output_dir, exist_ok=True)
+    regenerated = []
+    for name, url, schema, diff in changed:
+        try:
+            write_batch_file(output_dir, f'{name}.sql', render_schema_diff(name, diff) + '\n' + render_featurelayer_batch_sql(layers[name], gis=gis))
+        except Exception as e:
+            print(f"WARNING: Could not regenerate '{name}': {e!r}")
+            continue
+        state[name] = {'url': url, 'fingerprint': get_schema_fingerprint(schema), 'schema': schema}
+        regenerated.append(name)
+
+    if regenerated:
+        save_schema_state(state, state_path)
+    return regenerated
+
+# In[56]:
+
+# watch mode: polls each service root, one small request per service however many of its layers are watched, and
+# only regenerates when the service's schemaLastEditDate moved (or lastEditDate, for services that do not report
+# schema edits). polls are conditional, so unchanged services usually answer 304 with no body. map services have no
+# editingInfo and are only checked when the watcher starts
+WATCH_INTERVAL = float(os.environ.get('FEATURESERVICE_HELPER_WATCH_INTERVAL', 300))
+
+
+def get_service_edit_dates(
+    properties : dict
+) -> tuple:
+    editing_info = properties.get('editingInfo') or {}
+    return editing_info.get('schemaLastEditDate'), editing_info.get('lastEditDate')
+
+def poll_service_edit_dates(
+    service_url : str,
+    gis : GIS,
+    watched : dict
+) -> bool:
+    # polls the service root and returns True when its edit dates moved since the last poll. watched holds the
+    # validators and edit dates of the last response and is updated in place
+    properties, validators = schedule_request(service_url, lambda: get_backend(gis).get_json_if_modified(service_url, watched.get('validators')))
+    watched['validators'] = validators
+    if properties is None:
+        return False
+
+    schema_last_edit_date, last_edit_date = get_service_edit_dates(properties)
+    previous = watched.get('edit_dates')
+    watched['edit_dates'] = (schema_last_edit_date, last_edit_date)
+    # later revalidations of the layer cache compare against the newest service json
+    _service_properties_cache[service_url] = properties
+    if previous is None:
+        return False
+    if schema_last_edit_date is not None or previous[0] is not None:
+        return schema_last_edit_date != previous[0]
+    return last_edit_date != previous[1]
+
+def refresh_service_layer_properties(
+    service_url : str,
+    featurelayer_urls : list,
+    gis : GIS
+) -> None:
+    # refetches the layers of a changed service, in one /layers request where the service returns them all
+    for url in featurelayer_urls:
+        _layer_properties_cache.pop(url, None)
+    for key in [key for key in _shard_plan_cache if key[0] in featurelayer_urls]:
+        del _shard_plan_cache[key]
+    fetch_service_layer_properties(service_url, featurelayer_urls, gis=gis)
+    for url in featurelayer_urls:
+        if url not in _layer_properties_cache:
+            get_featurelayer_properties(url, gis=gis, refresh=True)
+
+def watch_featurelayers(
+    layers : list,
+    gis : GIS,
+    output_dir : str,
+    interval : float = None,
+    state_path : str = None,
+    max_polls : int = None
+) -> None:
+    # regenerates the manifest layers whose schema changed since the last recorded run, then polls until
+    # interrupted (or for max_polls polls). a service that fails to poll or regenerate is reported and tried again
+    # on the next poll
+    interval = WATCH_INTERVAL if interval is None else interval
+    services = defaultdict(list)
+    for layer in layers:
+        services[get_service_url(layer['url'])].append(layer)
+    watched = {service_url: {} for service_url in services if service_url.endswith('/FeatureServer')}
+    for service_url in services:
+        if service_url not in watched:
+            print(f"WARNING: '{service_url}' does not report edit dates and is only checked at startup")
+
+    for service_url in watched:
+        try:
+            poll_service_edit_dates(service_url, gis=gis, watched=watched[service_url])
+            # cached layers are trusted for LAYER_CACHE_TTL, so the ones cached before the service's latest schema
+            # edit are refetched before the startup check
+            schema_last_edit_date = watched[service_url]['edit_dates'][0]
+            stale_urls = [
+                layer['url'] for layer in services[service_url]
+                if (read_layer_cache_entry(layer['url']) or {}).get('schema_last_edit_date') != schema_last_edit_date
+            ]
+            if stale_urls and not OFFLINE_SNAPSHOT_DIR:
+                refresh_service_layer_properties(service_url, stale_urls, gis=gis)
+        except Exception as e:
+            print(f"WARNING: Could not poll '{service_url}': {e!r}")
+    for name in regenerate_featurelayer_batch(layers, gis=gis, output_dir=output_dir, state_path=state_path):
+        print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} regenerated {name}")
+
+    polls = 0
+    while max_polls is None or polls < max_polls:
+        time.sleep(interval)
+        polls += 1
+        for service_url, service_layers in services.items():
+            if service_url not in watched:
+                continue
+            try:
+                if not poll_service_edit_dates(service_url, gis=gis, watched=watched[service_url]):
+                    continue
+                refresh_service_layer_properties(service_url, [layer['url'] for layer in service_layers], gis=gis)
+                regenerated = regenerate_featurelayer_batch(service_layers, gis=gis, output_dir=output_dir, state_path=state_path)
+            except Exception as e:
+                print(f"WARNING: Could not check '{service_url}': {e!r}")
+                continue
+            for name in regenerated:
+                print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} regenerated {name}")
+        if METRICS_DIR:
+            write_run_metrics(METRICS_DIR)
+
+def get_cli_backend(
+    args : argparse.Namespace
+) -> GIS:
+    # the module's gis unless the command line names a portal, which is then read through RestBackend
+    if args.offline_dir:
+        set_offline_mode(args.offline_dir)
+    if args.portal:
+        return RestBackend(url=args.portal, username=args.username, password=os.environ.get('FEATURESERVICE_HELPER_PASSWORD'))
+    return gis
+
+def main(
+    argv : list = None
+) -> int:
+    # the connection options are accepted before or after the command. the commands default them to SUPPRESS so
+    # they do not overwrite a value given before the command
+    def add_connection_arguments(parser, default):
+        parser.add_argument('--portal', default=default, help='portal url to read through the rest api instead of the arcgis profile')
+        parser.add_argument('--username', default=default, help='portal username, the password is read from FEATURESERVICE_HELPER_PASSWORD')
+        parser.add_argument('--offline-dir', default=default, help='read only from the schema snapshots in this directory')
+
+    parser = argparse.ArgumentParser(description='Generates the Azure ingest sql for ArcGIS feature layers.')
+    add_connection_arguments(parser, None)
+    connection = argparse.ArgumentParser(add_help=False)
+    add_connection_arguments(connection, argparse.SUPPRESS)
+    commands = parser.add_subparsers(dest='command', required=True)
+    generate = commands.add_parser('generate', parents=[connection], help='write the sql of every layer in a manifest')
+    generate.add_argument('manifest', help='json layer manifest')
+    generate.add_argument('-o', '--output-dir', default='generated', help='where the sql and manifest.json are written')
+    watch = commands.add_parser('watch', parents=[connection], help='regenerate the sql of the layers in a manifest whenever their schema changes')
+    watch.add_argument('manifest', help='json layer manifest')
+    watch.add_argument('-o', '--output-dir', default='generated', help='where the regenerated sql is written')
+    watch.add_argument('--interval', type=float, help=f'seconds between polls, {WATCH_INTERVAL:g} by default')
+    watch.add_argument('--state-path', help=f'recorded layer schemas, {SCHEMA_STATE_PATH} by default')
+    args = parser.parse_args(argv)
+
+    backend = get_cli_backend(args)
+    status = 0
+    if args.command == 'generate':
+        entries = generate_featurelayer_batch(load_layer_manifest(args.manifest), gis=backend, output_dir=args.output_dir)
+        failed = [entry['name'] for entry in entries if entry['status'] != 'ok']
+        print(f'{len(entries) - len(failed)} of {len(entries)} layers written to {args.output_dir}')
+        if failed:
+            print(f"WARNING: Failed layers: {', '.join(failed)}")
+            status = 1
+    elif args.command == 'watch':
+        try:
+            watch_featurelayers(load_layer_manifest(args.manifest), gis=backend, output_dir=args.output_dir, interval=args.interval, state_path=args.state_path)
+        except KeyboardInterrupt:
+            pass
+    if METRICS_DIR:
+        write_run_metrics(METRICS_DIR)
+    return status
+
 # In[50]:
 
 # print_geolookup_fields(['COUNCIL2021', 'LEGISLATIVE2022', 'CONGRESS2021', 'PARKPOLICEBEAT', 'REGIONALSERVICECENTER', 'CENSUSTRACT2020', 'CENSUSTRACT2010'])
 # In[50]:
 
+# (name, layer url, item id). the item id is the portal item of the layer's service, used to look up its owner's
+# secret name for the stage parameters, and None when the service has no item in the portal
 layers = [
-    # ('Benches', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Montgomery_Parks_Benches/FeatureServer/0'), # 19ce5bf022dc4193aeac8b18833e094f
-    # ('BikeAssets', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Bike_Assets/FeatureServer/0'), # 46de90ff5980452b9beffe37d377252a
-    # ('Kiosks', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Kiosks_and_Signs/FeatureServer/1'), # d4a8d962a98a4944bfd665fe8bea2fcb
-    # ('SignLocations', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Kiosks_and_Signs/FeatureServer/0'), # d4a8d962a98a4944bfd665fe8bea2fcb
-    # ('AssetsOther', 'https://montgomeryplans.org/server/rest/services/Parks/Assets_Pt/FeatureServer/0'),
-    # ('Courts', 'https://montgomeryplans.org/server/rest/services/Courts/Courts/FeatureServer/0'), # 151a6f063c2a468fa927c2150d909da1
-    # ('CourtPads', 'https://montgomeryplans.org/server/rest/services/Courts/Courts/FeatureServer/1'), # 151a6f063c2a468fa927c2150d909da1
-    # ('PortaJohnLocations', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Portajohn_Locations/FeatureServer/1'), # e2d98f9697a84f94b41f3455b9db38a5
-    # ('PicnicShelters', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/PicnicShelters/FeatureServer/0'), # a067549da0e44ad59fe4e5999cca3304
-    # ('TreeInventory', 'https://montgomeryplans.org/server/rest/services/Arboriculture/TreeInventory_Pt/FeatureServer/0'), # e2d98f9697a84f94b41f3455b9db38a5
-    # ('TreeSpecies', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Tree_Species_List/FeatureServer/0'), # 2be8dd3aa4df498e8213138fe0c06168
-    # ('AthleticFields', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/AthleticFields/FeatureServer/0'), # 87ccb6bc975e41178ae4f05ff6834324
-    # ('CensusTracts2020', 'https://tigerweb.geo.census.gov/arcgis/rest/services/Census2020/tigerWMS_Census2020/MapServer/6'),
-    # ('ParkUnits', 'https://montgomeryplans.org/server/rest/services/Parks/ParkUnits_Py/FeatureServer/0'), # 727bab07c5da4c81b88cabdf16a5cf44
-    # ('CensusTracts2010', 'https://tigerweb.geo.census.gov/arcgis/rest/services/TIGERweb/tigerWMS_Census2010/MapServer/14'),
-    # ('Bleachers', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Bleachers/FeatureServer/0'), # fb8f7d0b1a4c4ef79d7b8d0987364844
-    # ('Playgrounds', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Playgrounds_Editable/FeatureServer/0'), # 524972064e324e70a61dfdbfefe875c6
-    # ('CommunityGardens', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Montgomery_Parks_Community_Gardens/FeatureServer/1'), # ab1834b34cbd47369833c8131aa58d09
-    # ('ElectricTelecomPoints', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Park_Utilities/FeatureServer/0'), # e43c4107390e4211a862469ded34bb1e
-    # ('DogParks', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Dog_Parks/FeatureServer/0'), # 0044b8efb8184c1caaeb41820eb5261f
-    # ('BikeSkateParks', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Skate_Parks/FeatureServer/0'), # 9b81d15eccd541ba96073ba3de6175df
-    # ('BCISurveySites', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/ArcGIS/rest/services/BCI_SurveyPoints/FeatureServer/0'), # 40f32a2db2c44223a13c4126f5441c1f
-    # ('BCISurveyResults', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/ArcGIS/rest/services/BCI_SurveyPoints/FeatureServer/2'), # 40f32a2db2c44223a13c4126f5441c1f
-    # ('BCISoundMonitorResults', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/ArcGIS/rest/services/BCI_SurveyPoints/FeatureServer/4'), # 40f32a2db2c44223a13c4126f5441c1f
-    # ('BCISpecies', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/ArcGIS/rest/services/BCI_SurveyPoints/FeatureServer/3'), # 40f32a2db2c44223a13c4126f5441c1f
-    # ('WWLocations', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/ac030a/FeatureServer/0'), # 8e0ca62908d94cedb5919f82eadf370c
-    # ('TrailUnits', 'https://montgomeryplans.org/server/rest/services/Trails/TrailUnits_Ln_EDIT/FeatureServer/0'), # 538a3b30596a42b58aea4957e58d3af0
-    # ('BridgesBoardwalksCulvertsDocks', 'https://utility.arcgis.com/usrsvcs/servers/b9b1473ecb3e4fe89d4b6fcd7d5a94bd/rest/services/EnvironmentalEngineering/ParkBridges_Pt_EDIT/FeatureServer/0'), # b9b1473ecb3e4fe89d4b6fcd7d5a94bd, url=https://montgomeryplans.org/server/rest/services/EnvironmentalEngineering/ParkBridges_Pt_EDIT/FeatureServer/0
-    # ('TrailCounterSites', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/TrailCounters/FeatureServer/0'), # 0d3b5b42f46c417d87e08e9b0d1de41f
-    # ('Meadows', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Montgomery_Parks_Meadows/FeatureServer/0'), # 3a1e87352337435db98fdb2ebdda640e,
-    # ('ReforestationSites', 'https://utility.arcgis.com/usrsvcs/servers/dc1665c1e5b746cd8804899b9cc33bc5/rest/services/NaturalResources/ReforestationSites_Py_EDIT/FeatureServer/0'), # dc1665c1e5b746cd8804899b9cc33bc5 url=https://montgomeryplans.org/server/rest/services/NaturalResources/ReforestationSites_Py_EDIT/FeatureServer/0
-    # ('BioMonVisits', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/BioMon_EDIT/FeatureServer/0'), # e30e7a3a36cc4d47a22dc8daf83f2eeb,
-    # ('BioMonShockers', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/BioMon_EDIT/FeatureServer/1'), # e30e7a3a36cc4d47a22dc8daf83f2eeb,
-    # ('BioMonFishCounts', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/BioMon_EDIT/FeatureServer/2'), # e30e7a3a36cc4d47a22dc8daf83f2eeb,
-    # ('BioMonGameFish', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/BioMon_EDIT/FeatureServer/3'), # e30e7a3a36cc4d47a22dc8daf83f2eeb,
-    # ('BioMonPersonnel', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/BioMon_EDIT/FeatureServer/4'), # e30e7a3a36cc4d47a22dc8daf83f2eeb,
-    # ('WaterSewerPoints', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Park_Utilities/FeatureServer/4'), # e43c4107390e4211a862469ded34bb1e
-    # ('SportAmenities', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Sport_Amenities_Editable/FeatureServer/0'), # 93d81985eb314ff5bb8cf63d25a88b91
-    # ('EphemeralWetlands', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/service_d5317a9e7b454349a9c5732995e39e47/FeatureServer/0'), # 3c81fe788d7f4d598cc7e0e23a37c334
-    # ('EphemeralWetlandsIncidental', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/service_d5317a9e7b454349a9c5732995e39e47/FeatureServer/1'), # 3c81fe788d7f4d598cc7e0e23a37c334
-    # ('EphemeralWetlandsHerpSearch', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/service_d5317a9e7b454349a9c5732995e39e47/FeatureServer/2'), # 3c81fe788d7f4d598cc7e0e23a37c334
-    # ('FrogWatchLocations', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/FrogWatch_Locations/FeatureServer/0'), # baacf525e30745c483d11ca022d98d8f
-    # ('BioMonFishTaxa', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/BioMon_FishTaxa_EDIT/FeatureServer/0'), # 75358d1fad194906bd4514d0be217c1e
-    # ('PortableRestrooms', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Portajohn_Locations/FeatureServer/0'), # e2d98f9697a84f94b41f3455b9db38a5
-    # ('NonPortableRestrooms', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Non_Portable_Restrooms/FeatureServer/0'), # 8bef363753c842d0a367bf485e135e8f
-    # ('ParkingLots', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/ParkingLots/FeatureServer/0'), # c68614b55f43435088ce094ac7c78b74
+    # ('Benches', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Montgomery_Parks_Benches/FeatureServer/0', '19ce5bf022dc4193aeac8b18833e094f'),
+    # ('BikeAssets', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Bike_Assets/FeatureServer/0', '46de90ff5980452b9beffe37d377252a'),
+    # ('Kiosks', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Kiosks_and_Signs/FeatureServer/1', 'd4a8d962a98a4944bfd665fe8bea2fcb'),
+    # ('SignLocations', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Kiosks_and_Signs/FeatureServer/0', 'd4a8d962a98a4944bfd665fe8bea2fcb'),
+    # ('AssetsOther', 'https://montgomeryplans.org/server/rest/services/Parks/Assets_Pt/FeatureServer/0', None),
+    # ('Courts', 'https://montgomeryplans.org/server/rest/services/Courts/Courts/FeatureServer/0', '151a6f063c2a468fa927c2150d909da1'),
+    # ('CourtPads', 'https://montgomeryplans.org/server/rest/services/Courts/Courts/FeatureServer/1', '151a6f063c2a468fa927c2150d909da1'),
+    # ('PortaJohnLocations', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Portajohn_Locations/FeatureServer/1', 'e2d98f9697a84f94b41f3455b9db38a5'),
+    # ('PicnicShelters', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/PicnicShelters/FeatureServer/0', 'a067549da0e44ad59fe4e5999cca3304'),
+    # ('TreeInventory', 'https://montgomeryplans.org/server/rest/services/Arboriculture/TreeInventory_Pt/FeatureServer/0', 'e2d98f9697a84f94b41f3455b9db38a5'),
+    # ('TreeSpecies', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Tree_Species_List/FeatureServer/0', '2be8dd3aa4df498e8213138fe0c06168'),
+    # ('AthleticFields', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/AthleticFields/FeatureServer/0', '87ccb6bc975e41178ae4f05ff6834324'),
+    # ('CensusTracts2020', 'https://tigerweb.geo.census.gov/arcgis/rest/services/Census2020/tigerWMS_Census2020/MapServer/6', None),
+    # ('ParkUnits', 'https://montgomeryplans.org/server/rest/services/Parks/ParkUnits_Py/FeatureServer/0', '727bab07c5da4c81b88cabdf16a5cf44'),
+    # ('CensusTracts2010', 'https://tigerweb.geo.census.gov/arcgis/rest/services/TIGERweb/tigerWMS_Census2010/MapServer/14', None),
+    # ('Bleachers', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Bleachers/FeatureServer/0', 'fb8f7d0b1a4c4ef79d7b8d0987364844'),
+    # ('Playgrounds', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Playgrounds_Editable/FeatureServer/0', '524972064e324e70a61dfdbfefe875c6'),
+    # ('CommunityGardens', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Montgomery_Parks_Community_Gardens/FeatureServer/1', 'ab1834b34cbd47369833c8131aa58d09'),
+    # ('ElectricTelecomPoints', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Park_Utilities/FeatureServer/0', 'e43c4107390e4211a862469ded34bb1e'),
+    # ('DogParks', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Dog_Parks/FeatureServer/0', '0044b8efb8184c1caaeb41820eb5261f'),
+    # ('BikeSkateParks', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Skate_Parks/FeatureServer/0', '9b81d15eccd541ba96073ba3de6175df'),
+    # ('BCISurveySites', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/ArcGIS/rest/services/BCI_SurveyPoints/FeatureServer/0', '40f32a2db2c44223a13c4126f5441c1f'),
+    # ('BCISurveyResults', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/ArcGIS/rest/services/BCI_SurveyPoints/FeatureServer/2', '40f32a2db2c44223a13c4126f5441c1f'),
+    # ('BCISoundMonitorResults', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/ArcGIS/rest/services/BCI_SurveyPoints/FeatureServer/4', '40f32a2db2c44223a13c4126f5441c1f'),
+    # ('BCISpecies', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/ArcGIS/rest/services/BCI_SurveyPoints/FeatureServer/3', '40f32a2db2c44223a13c4126f5441c1f'),
+    # ('WWLocations', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/ac030a/FeatureServer/0', '8e0ca62908d94cedb5919f82eadf370c'),
+    # ('TrailUnits', 'https://montgomeryplans.org/server/rest/services/Trails/TrailUnits_Ln_EDIT/FeatureServer/0', '538a3b30596a42b58aea4957e58d3af0'),
+    # ('BridgesBoardwalksCulvertsDocks', 'https://utility.arcgis.com/usrsvcs/servers/b9b1473ecb3e4fe89d4b6fcd7d5a94bd/rest/services/EnvironmentalEngineering/ParkBridges_Pt_EDIT/FeatureServer/0', 'b9b1473ecb3e4fe89d4b6fcd7d5a94bd'), # url=https://montgomeryplans.org/server/rest/services/EnvironmentalEngineering/ParkBridges_Pt_EDIT/FeatureServer/0
+    # ('TrailCounterSites', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/TrailCounters/FeatureServer/0', '0d3b5b42f46c417d87e08e9b0d1de41f'),
+    # ('Meadows', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Montgomery_Parks_Meadows/FeatureServer/0', '3a1e87352337435db98fdb2ebdda640e'),
+    # ('ReforestationSites', 'https://utility.arcgis.com/usrsvcs/servers/dc1665c1e5b746cd8804899b9cc33bc5/rest/services/NaturalResources/ReforestationSites_Py_EDIT/FeatureServer/0', 'dc1665c1e5b746cd8804899b9cc33bc5'), # url=https://montgomeryplans.org/server/rest/services/NaturalResources/ReforestationSites_Py_EDIT/FeatureServer/0
+    # ('BioMonVisits', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/BioMon_EDIT/FeatureServer/0', 'e30e7a3a36cc4d47a22dc8daf83f2eeb'),
+    # ('BioMonShockers', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/BioMon_EDIT/FeatureServer/1', 'e30e7a3a36cc4d47a22dc8daf83f2eeb'),
+    # ('BioMonFishCounts', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/BioMon_EDIT/FeatureServer/2', 'e30e7a3a36cc4d47a22dc8daf83f2eeb'),
+    # ('BioMonGameFish', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/BioMon_EDIT/FeatureServer/3', 'e30e7a3a36cc4d47a22dc8daf83f2eeb'),
+    # ('BioMonPersonnel', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/BioMon_EDIT/FeatureServer/4', 'e30e7a3a36cc4d47a22dc8daf83f2eeb'),
+    # ('WaterSewerPoints', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Park_Utilities/FeatureServer/4', 'e43c4107390e4211a862469ded34bb1e'),
+    # ('SportAmenities', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Sport_Amenities_Editable/FeatureServer/0', '93d81985eb314ff5bb8cf63d25a88b91'),
+    # ('EphemeralWetlands', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/service_d5317a9e7b454349a9c5732995e39e47/FeatureServer/0', '3c81fe788d7f4d598cc7e0e23a37c334'),
+    # ('EphemeralWetlandsIncidental', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/service_d5317a9e7b454349a9c5732995e39e47/FeatureServer/1', '3c81fe788d7f4d598cc7e0e23a37c334'),
+    # ('EphemeralWetlandsHerpSearch', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/service_d5317a9e7b454349a9c5732995e39e47/FeatureServer/2', '3c81fe788d7f4d598cc7e0e23a37c334'),
+    # ('FrogWatchLocations', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/FrogWatch_Locations/FeatureServer/0', 'baacf525e30745c483d11ca022d98d8f'),
+    # ('BioMonFishTaxa', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/BioMon_FishTaxa_EDIT/FeatureServer/0', '75358d1fad194906bd4514d0be217c1e'),
+    # ('PortableRestrooms', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Portajohn_Locations/FeatureServer/0', 'e2d98f9697a84f94b41f3455b9db38a5'),
+    # ('NonPortableRestrooms', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/Non_Portable_Restrooms/FeatureServer/0', '8bef363753c842d0a367bf485e135e8f'),
+    # ('ParkingLots', 'https://services1.arcgis.com/HbzrdBZjOwNHp70P/arcgis/rest/services/ParkingLots/FeatureServer/0', 'c68614b55f43435088ce094ac7c78b74'),
 ]
+# the geolookups each layer's ddl includes, keyed by layer name. layers that are not listed get every lookup in
+# GEOLOOKUPS, and an empty list drops the geolookup columns entirely
+LAYER_GEOLOOKUPS = {
+    # 'CensusTracts2020': [],
+    # 'Benches': ['COUNCIL2021', 'PARKPOLICEBEAT', 'REGIONALSERVICECENTER', 'GEOM_PARK_CODE'],
+}
+# In[ ]:
+# only runs as a script or notebook cell, so the module can be imported without touching the network
+if __name__ == '__main__':
+    # python FeatureService_Azure_Helper.py generate layers.json -o generated, see main
+    if any(argument in CLI_COMMANDS for argument in sys.argv[1:]):
+        sys.exit(main())
+
+    # fetches all layer properties up front in parallel, the loop below then renders from the cache in order. a layer
+    # that still fails after the retries is reported and skipped
+    prefetch_featurelayer_properties([layer[1] for layer in layers], gis=gis, skip_failed=True)
+    prefetch_item_owners([layer[2] for layer in layers], gis=gis)
+    for layer in layers:
+        print(layer[0])
+        try:
+            # print('')
+            print(get_featurelayer_field_names(layer[1], gis=gis))
+            print('')
+            print(get_featurelayer_stage_parameters(layer[1], gis=gis, name=layer[0], item_id=layer[2]))
+            print('')
+            print(get_featurelayer_bronzesqlfields(layer[1], gis=gis, name=layer[0], geolookups=LAYER_GEOLOOKUPS.get(layer[0])))
+            print('')
+            # print(get_featurelayer_bronzesqlview(layer[1], gis=gis, name=layer[0], geolookups=LAYER_GEOLOOKUPS.get(layer[0])))
+            # print('')
+            print(get_featurelayer_silversqlprocedure(layer[1], gis=gis, name=layer[0], geolookups=LAYER_GEOLOOKUPS.get(layer[0])))
+            print('')
+        except Exception as e:
+            print(f"WARNING: Skipped '{layer[0]}': {e!r}")
+            print('')
+
+    # where the run's time went, for the scheduler when METRICS_DIR is set and otherwise printed after the sql
+    if METRICS_DIR:
+        write_run_metrics(METRICS_DIR)
+    else:
+        print(render_run_metrics_json())
+
+# In[ ]:
+# checks local bronze parquet files, e.g. downloaded with azcopy, against the generated bronze ddl
+# print(render_conformance_report(check_featurelayers_parquet_conformance(layers, gis=gis, bronze_dir='bronze/gis-bronze')))
+
+# In[ ]:
+# catalogs every layer, then answers cross layer questions from it, e.g. which layers share the EAM columns below
+# catalog = SchemaCatalog()
+# catalog.add_layers(layers, gis=gis)
+# print(catalog.layers_with_field('PARK_CODE'))
+# print(catalog.field_usage('SIZE_'))
+# print(catalog.layers_sharing_fields(re.findall(r'\[(.+?)\]', sql), min_shared=5))
+# print(get_featurelayer_bronzesqlfields(catalog.get_layer_url('Benches'), gis=catalog, name='Benches'))
+
 # In[ ]:
-for layer in layers:
-    print(layer[0])
-    # print('')
-    print(get_featurelayer_field_names(layer[1], gis=gis))
-    print('')
-    print(get_featurelayer_stage_parameters(layer[1], gis=gis, name=layer[0]))
-    print('')
-    print(get_featurelayer_bronzesqlfields(layer[1], gis=gis, name=layer[0]))
-    print('')
-    print(get_featurelayer_silversqlprocedure(layer[1], gis=gis, name=layer[0]))
-    print('')
+# only regenerates the layers whose schema changed since the last recorded run
+# for name, sql in regenerate_changed_featurelayers(layers, gis=gis):
+#     print(sql)
 
 # In[ ]:
 # sql = ''''''
@@ -592,5 +3043,6 @@ sql = '''
 ,[GEOMTYPE]
 '''
 
-print(get_prefixed_field_aliases(sql, 'GIS'))
+if __name__ == '__main__':
+    print(get_prefixed_field_aliases(sql, 'GIS'))
 # %%